@@ -1,30 +1,32 @@
 from abc import ABC
 from archive.entity.article import Artikel as ArtikelEntity, GambarArtikel as GambarArtikelEntity
 from .dto import Artikel, GambarArtikel
-from pkg.conn.database import engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from archive.entity.article import GetArticlesRequest, GetArticleByIDRequest, GetGambarArticlesByArticleIDs
 
 
 class ArticleRepository(ABC):
-    def __init__(self) -> None:
+    def __init__(self, session: AsyncSession) -> None:
         super().__init__()
 
-        _session = sessionmaker(bind=engine)
-        self.session = _session()
+        self.session = session
 
     async def get_articles(self, req: GetArticlesRequest) -> list[ArtikelEntity]:
-        articles = self.session.query(Artikel).all()
+        result = await self.session.execute(select(Artikel))
+        articles = result.scalars().all()
 
         return [article.to_entity() for article in articles]
 
     async def get_article_by_id(self, req: GetArticleByIDRequest) -> ArtikelEntity:
-        artikel = self.session.query(Artikel).filter(Artikel.id == req.id).first()
+        result = await self.session.execute(select(Artikel).where(Artikel.id == req.id))
+        artikel = result.scalars().first()
 
         return artikel.to_entity()
 
     async def get_gambar_articles_by_artikel_ids(self, req: GetGambarArticlesByArticleIDs) -> list[GambarArtikelEntity]:
-        gambar_artikel = self.session.query(GambarArtikel).filter(GambarArtikel.artikel_id.in_(req.artikel_ids)).all()
+        result = await self.session.execute(select(GambarArtikel).where(GambarArtikel.artikel_id.in_(req.artikel_ids)))
+        gambar_artikel = result.scalars().all()
 
         final_return = []
         for gambar in gambar_artikel:
@@ -1,11 +1,12 @@
+from sqlalchemy.ext.asyncio import AsyncSession
 from archive.entity.article import Artikel, GetArticlesRequest, GetArticleByIDRequest, GetGambarArticlesByArticleIDs
 from archive.article_repository.implement import ArticleRepository
 
 
 class ArticleUseCase:
-    def __init__(self) -> None:
+    def __init__(self, session: AsyncSession) -> None:
         super().__init__()
-        self.ArticleRepo = ArticleRepository()
+        self.ArticleRepo = ArticleRepository(session)
 
     async def get_articles(self, req: GetArticlesRequest) -> list[Artikel]:
         articles = await self.ArticleRepo.get_articles()
@@ -0,0 +1,116 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+# results are kept out of git, one file per run named after the commit it measured
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    # nearest rank, the values are already sorted
+    if not sorted_values:
+        return 0.0
+
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    latencies = sorted(latencies)
+
+    return {
+        'count': len(latencies),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        'p50_us': round(percentile(latencies, 0.50) * 1e6, 2),
+        'p99_us': round(percentile(latencies, 0.99) * 1e6, 2),
+        'max_us': round(latencies[-1] * 1e6, 2) if latencies else 0.0,
+    }
+
+
+def measure_allocations(call, iterations: int) -> dict:
+    # tracemalloc slows everything down, so this runs as its own pass after the timed one
+    tracemalloc.start()
+    try:
+        peak, blocks = 0, 0
+        for _ in range(iterations):
+            before = sys.getallocatedblocks()
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            call()
+            _, call_peak = tracemalloc.get_traced_memory()
+            peak += call_peak - baseline
+            blocks += sys.getallocatedblocks() - before
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'peak_bytes_per_call': round(peak / iterations, 1),
+        'retained_blocks_per_call': round(blocks / iterations, 2),
+    }
+
+
+def git_revision() -> tuple[str, bool]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+    return commit, dirty
+
+
+def save_results(suite: str, parameters: dict, results: dict) -> Path:
+    commit, dirty = git_revision()
+    RESULTS_DIR.mkdir(exist_ok=True)
+
+    previous = latest_results(suite)
+    path = RESULTS_DIR / f"{suite}-{time.strftime('%Y%m%dT%H%M%S')}-{commit}{'-dirty' if dirty else ''}.json"
+    path.write_text(json.dumps({
+        'suite': suite,
+        'commit': commit,
+        'dirty': dirty,
+        'at': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'parameters': parameters,
+        'results': results,
+    }, indent=2))
+
+    if previous is not None:
+        compare(previous, results)
+
+    return path
+
+
+def latest_results(suite: str):
+    paths = sorted(RESULTS_DIR.glob(f'{suite}-*.json')) if RESULTS_DIR.exists() else []
+    return json.loads(paths[-1].read_text()) if paths else None
+
+
+def compare(previous: dict, results: dict) -> None:
+    # ratio against the last saved run of the suite, > 1 means slower for latencies and faster for throughput
+    print(f"\ncompared with {previous['commit']}{' (dirty)' if previous['dirty'] else ''}:")
+    for case, current in results.items():
+        before = previous['results'].get(case)
+        if before is None:
+            continue
+
+        ratios = []
+        for key in ('throughput', 'p50_us', 'p99_us', 'peak_bytes_per_call'):
+            if before.get(key) and key in current:
+                ratios.append(f'{key} x{current[key] / before[key]:.2f}')
+
+        print(f"  {case:<32} {', '.join(ratios)}")
+
+
+def print_table(results: dict) -> None:
+    print(f"{'case':<32} {'ops/s':>12} {'p50 us':>10} {'p99 us':>10} {'peak B':>10} {'blocks':>8}")
+    for case, result in results.items():
+        print(f"{case:<32} {result['throughput']:>12} {result['p50_us']:>10} {result['p99_us']:>10} "
+              f"{result.get('peak_bytes_per_call', '-'):>10} {result.get('retained_blocks_per_call', '-'):>8}")
@@ -0,0 +1,242 @@
+# macro benchmark of the data endpoints against a throwaway local postgres, the app runs in process:
+#   GENAPI_DB_HOST=localhost GENAPI_DB_USERNAME=postgres GENAPI_DB_PASSWORD=postgres GENAPI_DB_NAME=genapi_bench \
+#   python -m benchmarks.endpoints_bench [--requests 2000] [--concurrency 16]
+# the bench_ tables are created in the public schema and dropped afterwards unless --keep
+import argparse
+import asyncio
+import os
+import random
+import time
+import tracemalloc
+import orjson
+
+CUSTOMER_TABLE = 'bench_customer'
+ORDER_TABLE = 'bench_order'
+STATUSES = ['new', 'paid', 'shipped', 'cancelled']
+
+SEED_SQL = [
+    f'DROP TABLE IF EXISTS {ORDER_TABLE}, {CUSTOMER_TABLE}',
+    f'''CREATE TABLE {CUSTOMER_TABLE} (
+        id serial PRIMARY KEY,
+        name text NOT NULL,
+        email text NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    )''',
+    f'''CREATE TABLE {ORDER_TABLE} (
+        id serial PRIMARY KEY,
+        customer_id integer NOT NULL REFERENCES {CUSTOMER_TABLE} (id),
+        amount numeric(12, 2) NOT NULL,
+        status text NOT NULL,
+        created_at timestamptz NOT NULL DEFAULT now()
+    )''',
+    f'''INSERT INTO {CUSTOMER_TABLE} (name, email)
+        SELECT 'customer ' || n, 'customer' || n || '@example.com' FROM generate_series(1, $1) AS n''',
+    # setseed keeps the synthetic data identical between runs
+    'SELECT setseed(0.42)',
+    f'''INSERT INTO {ORDER_TABLE} (customer_id, amount, status)
+        SELECT 1 + (random() * ($1 - 1))::int, round((random() * 1000)::numeric, 2),
+               (ARRAY['new', 'paid', 'shipped', 'cancelled'])[1 + (random() * 3)::int]
+        FROM generate_series(1, $1 * $2)''',
+    f'CREATE INDEX ON {ORDER_TABLE} (status)',
+    f'CREATE INDEX ON {ORDER_TABLE} (customer_id)',
+    f'ANALYZE {CUSTOMER_TABLE}',
+    f'ANALYZE {ORDER_TABLE}',
+]
+
+
+async def seed(dsn: str, customers: int, orders_per_customer: int) -> None:
+    import asyncpg
+
+    connection = await asyncpg.connect(dsn)
+    try:
+        for statement in SEED_SQL:
+            # $1 is the number of customers, $2 the number of orders per customer
+            arguments = [customers, orders_per_customer][:2 if '$2' in statement else 1 if '$1' in statement else 0]
+            await connection.execute(statement, *arguments)
+    finally:
+        await connection.close()
+
+
+async def drop(dsn: str) -> None:
+    import asyncpg
+
+    connection = await asyncpg.connect(dsn)
+    try:
+        await connection.execute(SEED_SQL[0])
+    finally:
+        await connection.close()
+
+
+async def call(app, method: str, path: str, payload: dict) -> tuple[int, bytes]:
+    # a bare ASGI round trip, no sockets and no http client in the measurement
+    body = orjson.dumps(payload)
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status, chunks = 0, []
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # the disconnect watcher waits here until the response is done
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'server': ('bench', 80),
+        'client': ('bench', 0), 'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())],
+    }
+    await app(scope, receive, send)
+
+    return status, b''.join(chunks)
+
+
+def scenarios(customers: int, orders: int) -> dict:
+    # each scenario draws its payload from its own seeded generator, runs are repeatable
+    def data_table(rng: random.Random):
+        return 'POST', '/data/table', {
+            'table_name': ORDER_TABLE, 'page': rng.randint(1, 50), 'page_size': 20,
+            'query': [{'column_name': 'status', 'operator': '=', 'value': rng.choice(STATUSES)}],
+        }
+
+    def data_table_keyset(rng: random.Random):
+        return 'POST', '/data/table', {
+            'table_name': ORDER_TABLE, 'page_size': 20, 'pagination': 'keyset', 'order_by': ['amount'],
+            'query': [{'column_name': 'amount', 'operator': '>=', 'value': rng.randint(0, 900)}],
+        }
+
+    def data_table_id(rng: random.Random):
+        return 'POST', '/data/table/id', {'table_name': ORDER_TABLE, 'id': rng.randint(1, orders)}
+
+    def data_table_ids(rng: random.Random):
+        return 'POST', '/data/table/id', {'table_name': ORDER_TABLE, 'ids': [rng.randint(1, orders) for _ in range(50)]}
+
+    def put(rng: random.Random):
+        number = rng.randint(0, 10 ** 9)
+        return 'PUT', '/data/table', {'table_name': CUSTOMER_TABLE, 'data': {'name': f'bench {number}', 'email': f'bench{number}@example.com'}}
+
+    def patch(rng: random.Random):
+        return 'PATCH', '/data/table', {
+            'table_name': CUSTOMER_TABLE, 'primary_key_column': 'id',
+            'data': {'id': rng.randint(1, customers), 'name': f'renamed {rng.randint(0, 10 ** 9)}'},
+        }
+
+    return {
+        'data_table': data_table,
+        'data_table_keyset': data_table_keyset,
+        'data_table_id': data_table_id,
+        'data_table_ids': data_table_ids,
+        'put': put,
+        'patch': patch,
+    }
+
+
+async def run_scenario(app, payloads, requests: int, concurrency: int) -> tuple[list[float], float, int]:
+    latencies, errors = [], 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(method, path, payload):
+        nonlocal errors
+        async with semaphore:
+            started_at = time.perf_counter()
+            status, body = await call(app, method, path, payload)
+            latencies.append(time.perf_counter() - started_at)
+            # the endpoints report database errors as {'error': ...} with a 200
+            if status >= 400 or body.startswith(b'{"error"'):
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(one(*payloads()) for _ in range(requests)))
+
+    return latencies, time.perf_counter() - started_at, errors
+
+
+async def measure_request_allocations(app, payloads, iterations: int) -> dict:
+    # sequential, so the peak belongs to one request
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            await call(app, *payloads())
+            _, request_peak = tracemalloc.get_traced_memory()
+            peak += request_peak - baseline
+    finally:
+        tracemalloc.stop()
+
+    return {'peak_bytes_per_call': round(peak / iterations, 1)}
+
+
+async def run(args) -> dict:
+    # imported late, the settings above have to be in the environment before config is read
+    from main import app
+    from pkg.conn.database import DATABASE_DSN
+    from benchmarks.common import summarize
+
+    await seed(DATABASE_DSN, args.customers, args.orders_per_customer)
+    await app.router.startup()
+
+    results = {}
+    try:
+        selected = scenarios(args.customers, args.customers * args.orders_per_customer)
+        for name, scenario in selected.items():
+            if args.only and name not in args.only:
+                continue
+
+            rng = random.Random(f'{args.seed}-{name}')
+            payloads = lambda scenario=scenario, rng=rng: scenario(rng)
+
+            # the first requests fill the catalog cache, the statement caches and the pool
+            await run_scenario(app, payloads, args.warmup, args.concurrency)
+            latencies, elapsed, errors = await run_scenario(app, payloads, args.requests, args.concurrency)
+
+            result = summarize(latencies, elapsed)
+            result['errors'] = errors
+            result.update(await measure_request_allocations(app, payloads, args.allocation_iterations))
+            results[name] = result
+    finally:
+        await app.router.shutdown()
+        if not args.keep:
+            await drop(DATABASE_DSN)
+
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--allocation-iterations', type=int, default=100)
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--orders-per-customer', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', default=[])
+    # off by default, a cached response says nothing about the query path
+    parser.add_argument('--response-cache', action='store_true')
+    parser.add_argument('--keep', action='store_true')
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    os.environ['GENAPI_RESPONSE_CACHE_MAX_ENTRIES'] = '1024' if args.response_cache else '0'
+    os.environ.setdefault('GENAPI_RESPONSE_CACHE_LISTEN', 'false')
+    os.environ.setdefault('GENAPI_CATALOG_CACHE_LISTEN', 'false')
+
+    from benchmarks.common import save_results, print_table
+
+    results = asyncio.run(run(args))
+
+    print_table(results)
+    if not args.no_save:
+        path = save_results('endpoints', vars(args), results)
+        print(f'\nsaved {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# micro benchmark of the filter compiler, no database needed:
+#   python -m benchmarks.query_parser_bench [--iterations 20000]
+import argparse
+import random
+import time
+from core.entity.catalog import Condition, Query
+from core.repository.catalog_repository.query_parser import QueryParser, compile_shape
+from benchmarks.common import summarize, measure_allocations, save_results, print_table
+
+COLUMNS = [
+    {'column_name': f'col{index}', 'data_type': data_type}
+    for index, data_type in enumerate(['integer', 'bigint', 'text', 'character varying', 'numeric', 'boolean', 'timestamp with time zone', 'uuid'])
+]
+VALUES = {
+    'integer': 42, 'bigint': '9000000000', 'text': 'abc', 'character varying': 'xyz', 'numeric': '12.5',
+    'boolean': 'true', 'timestamp with time zone': '2024-01-01T00:00:00+00:00', 'uuid': '0b7e6a5c-3c48-4a43-9b2e-1f4d8a3f0e11',
+}
+SCALAR_OPERATORS = ['=', '!=', '<', '<=', '>', '>=']
+
+
+def condition(rng: random.Random) -> Condition:
+    column = rng.choice(COLUMNS)
+    return Condition(column_name=column['column_name'], operator=rng.choice(SCALAR_OPERATORS), value=VALUES[column['data_type']])
+
+
+def wide_query(rng: random.Random, width: int) -> list:
+    # width AND-ed conditions next to a group of width OR-ed ones
+    return [condition(rng) for _ in range(width)] + [Query(or_=[condition(rng) for _ in range(width)])]
+
+
+def deep_query(rng: random.Random, depth: int) -> list:
+    query = Query(and_=[condition(rng)], or_=[condition(rng), condition(rng)])
+    for _ in range(depth - 1):
+        query = Query(and_=[condition(rng), query], or_=[condition(rng)])
+
+    return [query]
+
+
+def in_query(rng: random.Random, size: int) -> list:
+    return [Condition(column_name='col0', operator='in', value=[rng.randint(0, 10 ** 6) for _ in range(size)]), condition(rng)]
+
+
+def cases(rng: random.Random) -> dict:
+    return {
+        'wide-10': wide_query(rng, 10),
+        'wide-100': wide_query(rng, 100),
+        'deep-5': deep_query(rng, 5),
+        'deep-30': deep_query(rng, 30),
+        'in-100': in_query(rng, 100),
+        'in-1000': in_query(rng, 1000),
+    }
+
+
+def time_calls(call, iterations: int) -> dict:
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        call_started_at = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - call_started_at)
+
+    return summarize(latencies, time.perf_counter() - started_at)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--allocation-iterations', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+
+    query_parser = QueryParser()
+    column_types = {column['column_name']: column['data_type'] for column in COLUMNS}
+
+    results = {}
+    for name, query in cases(random.Random(args.seed)).items():
+        # the shape cache is hit on every call after the first, as it is for a repeated request shape
+        def compile_warm(query=query):
+            query_parser.audition_filter_columns(COLUMNS, query)
+
+        # every call compiles the shape again, the cost of a shape seen for the first time
+        def compile_cold(query=query):
+            compile_shape.cache_clear()
+            query_parser.audition_filter_columns(COLUMNS, query)
+
+        # the tree walk alone, values coerced and the shape built but nothing rendered
+        def build_tree(query=query):
+            query_parser.build_group(query, column_types, [])
+
+        # cold runs are slower by nature, fewer of them keep the suite short
+        for variant, call, iterations in (('build', build_tree, args.iterations), ('warm', compile_warm, args.iterations), ('cold', compile_cold, args.iterations // 4 or 1)):
+            call()
+            result = time_calls(call, iterations)
+            result.update(measure_allocations(call, args.allocation_iterations))
+            results[f'{name}/{variant}'] = result
+
+    print_table(results)
+    if not args.no_save:
+        path = save_results('query_parser', vars(args), results)
+        print(f'\nsaved {path}')
+
+
+if __name__ == '__main__':
+    main()
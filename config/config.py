@@ -1,3 +1,4 @@
+from typing import Dict
 from pydantic_settings import BaseSettings
 
 
@@ -11,11 +12,64 @@ class GunicornConfig(BaseSettings):
     LOG_DEBUG: str = "DEBUG"
     LOG_ERROR: str = "ERROR"
     DB_DIALECT: str = "postgresql"
+    DB_DRIVER: str = "asyncpg"
     DB_HOST: str = ""
     DB_PORT: int = 5432
     DB_USERNAME: str = ""
     DB_PASSWORD: str = ""
     DB_NAME: str = ""
+    DB_POOL_MIN_SIZE: int = 5
+    DB_POOL_MAX_SIZE: int = 20
+    DB_POOL_TIMEOUT: int = 30
+    DB_STATEMENT_CACHE_SIZE: int = 500
+    # logs every statement synchronously, for local debugging only
+    DB_ECHO: bool = False
+    QUERY_SHAPE_CACHE_SIZE: int = 1024
+    STREAM_BATCH_SIZE: int = 1000
+    EXPAND_MAX_DEPTH: int = 5
+    BULK_BATCH_SIZE: int = 1000
+    COUNT_CAP: int = 10000
+    QUERY_GUARD_ENABLED: bool = False
+    QUERY_GUARD_ACTION: str = "reject"
+    QUERY_GUARD_MAX_COST: float = 0
+    QUERY_GUARD_MAX_ROWS: float = 0
+    # JSON, e.g. {"public.orders": {"max_cost": 100000, "max_rows": 50000}}
+    QUERY_GUARD_TABLE_LIMITS: Dict[str, Dict[str, float]] = {}
+    QUERY_GUARD_CACHE_SIZE: int = 1024
+    QUERY_GUARD_QUEUE_CONCURRENCY: int = 1
+    QUERY_GUARD_QUEUE_TIMEOUT: float = 30
+    # statement_timeout in milliseconds, 0 disables it; a table entry ("schema.table") wins over a route entry
+    # ("POST /data/table"), a route entry over the default
+    STATEMENT_TIMEOUT: int = 0
+    STATEMENT_TIMEOUT_ROUTES: Dict[str, int] = {}
+    STATEMENT_TIMEOUT_TABLES: Dict[str, int] = {}
+    DISCONNECT_POLL_INTERVAL: float = 0.25
+    # statements slower than SLOW_QUERY_MS (0 disables the log) are kept in a ring buffer of SLOW_QUERY_BUFFER_SIZE,
+    # a SLOW_QUERY_EXPLAIN_SAMPLE share of the slow reads is rerun under EXPLAIN (ANALYZE, BUFFERS)
+    SLOW_QUERY_MS: int = 500
+    SLOW_QUERY_EXPLAIN_SAMPLE: float = 0.1
+    SLOW_QUERY_BUFFER_SIZE: int = 100
+    # "X-Genapi-Profile: 1" or "?profile=1" returns a Server-Timing breakdown and keeps the timing tree for
+    # /debug/profiles, "cpu" instead of "1" also samples the stack when PROFILE_CPU_ENABLED
+    PROFILE_ENABLED: bool = True
+    PROFILE_BUFFER_SIZE: int = 50
+    PROFILE_CPU_ENABLED: bool = False
+    PROFILE_CPU_INTERVAL: float = 0.005
+    PROFILE_CPU_TOP_STACKS: int = 50
+    CATALOG_CACHE_TTL: int = 300
+    # least recently used tables are dropped beyond this many
+    CATALOG_CACHE_MAX_TABLES: int = 1024
+    CATALOG_CACHE_LISTEN: bool = True
+    CATALOG_CACHE_INSTALL_TRIGGER: bool = False
+    CATALOG_CACHE_CHANNEL: str = "genapi_ddl"
+    # the response cache is opt-in, set max entries above 0 to turn it on; entries expire after RESPONSE_CACHE_TTL
+    # seconds even if no write trigger (RESPONSE_CACHE_TRIGGER_TABLES) reports a change made outside genapi
+    RESPONSE_CACHE_MAX_ENTRIES: int = 0
+    RESPONSE_CACHE_TTL: int = 30
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    RESPONSE_CACHE_LISTEN: bool = True
+    RESPONSE_CACHE_CHANNEL: str = "genapi_write"
+    RESPONSE_CACHE_TRIGGER_TABLES: str = ""
 
     class Config:
         env_prefix = "GENAPI_"
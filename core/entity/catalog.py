@@ -11,6 +11,33 @@ FOREIGN_COLUMN_NAME = 'foreign_column_name'
 
 EMPTY_STRING = ''
 
+PAGINATION_OFFSET = 'offset'
+PAGINATION_KEYSET = 'keyset'
+
+EXPAND_PYTHON = 'python'
+EXPAND_LATERAL = 'lateral'
+
+BULK_VALUES = 'values'
+BULK_COPY = 'copy'
+
+# asyncpg (the postgres protocol) allows at most 32767 bind parameters per statement
+MAX_BIND_PARAMS = 32767
+
+STREAM_NDJSON = 'ndjson'
+STREAM_CSV = 'csv'
+
+SERIALIZATION_PYTHON = 'python'
+SERIALIZATION_DATABASE = 'database'
+
+COUNT_EXACT = 'exact'
+COUNT_ESTIMATED = 'estimated'
+COUNT_CAPPED = 'capped'
+
+# how a keyword search is answered, sequential means no index covers it
+SEARCH_FULLTEXT = 'fulltext'
+SEARCH_TRIGRAM = 'trigram'
+SEARCH_SEQUENTIAL = 'sequential'
+
 
 class GetTableColumnsRequest(BaseModel):
     schema_name: str = 'public'
@@ -36,8 +63,8 @@ class Condition(BaseModel):
 
 
 class Query(BaseModel):
-    and_: Union[List[Condition], 'Query'] = []
-    or_: Union[List[Condition], 'Query'] = []
+    and_: Union[List[Union[Condition, 'Query']], 'Query'] = []
+    or_: Union[List[Union[Condition, 'Query']], 'Query'] = []
 
 
 class GetTableDataRequest(BaseModel):
@@ -47,11 +74,52 @@ class GetTableDataRequest(BaseModel):
     page_size: int = 10
     keyword: str = ""
     custom_column: str = ""
-    id: Union[str, int, float, bool, UUID] = None
-    ids: List[Union[str, int, float, bool, UUID]] = []
+    # composite primary keys are given as {column: value} dicts
+    id: Union[str, int, float, bool, UUID, dict] = None
+    ids: List[Union[str, int, float, bool, UUID, dict]] = []
     is_composite_primary_key: bool = False
     primary_key_name: List[str] = []
-    query: List[Union[Query, Condition]] = []
+    query: List[Union[Condition, Query]] = []
+    # keyset pagination orders by order_by (plus the primary key as tie breaker) and seeks past cursor
+    pagination: str = PAGINATION_OFFSET
+    cursor: str = ""
+    order_by: List[str] = []
+    # python stitches foreign records after the page is read, lateral joins them in the same statement
+    expand_mode: str = EXPAND_PYTHON
+    # how many foreign key hops the python mode follows, 0 disables expansion
+    expand_depth: int = 1
+    # database lets postgres render the page as json, used for offset pages that need no python expansion
+    serialization: str = SERIALIZATION_PYTHON
+    # projection, "name" selects a column of the table, "customer.name" one of the expanded customer table;
+    # key and foreign key columns are always kept, empty means every column
+    fields: List[str] = []
+    # exact counts every match, estimated asks the planner, capped counts up to count_cap and reports "N+" beyond;
+    # empty returns the bare list of records, any mode returns {'data', 'count'}
+    count: str = ""
+    # 0 means GENAPI_COUNT_CAP
+    count_cap: int = 0
+
+
+class Aggregate(BaseModel):
+    # count, sum, avg, min or max; count also takes '*'
+    function: str
+    column_name: str = '*'
+    distinct: bool = False
+    # result key, defaults to function_column
+    alias: str = ""
+
+
+class AggregateTableDataRequest(BaseModel):
+    schema_name: str = 'public'
+    table_name: str
+    group_by: List[str] = []
+    aggregates: List[Aggregate] = []
+    query: List[Union[Condition, Query]] = []
+    keyword: str = ""
+    # group by columns or aggregate aliases, optionally followed by asc / desc
+    order_by: List[str] = []
+    # 0 returns every group
+    limit: int = 0
 
 
 class CreateTableRecordRequest(BaseModel):
@@ -60,3 +128,34 @@ class CreateTableRecordRequest(BaseModel):
     data: dict
     return_id: bool = True
     primary_key_column: str = None
+
+
+class BulkCreateTableRecordRequest(BaseModel):
+    schema_name: str = 'public'
+    table_name: str
+    data: List[dict] = []
+    # copy uses COPY FROM STDIN and cannot return ids, return_id always goes through multi-row VALUES
+    method: str = BULK_VALUES
+    # 0 means GENAPI_BULK_BATCH_SIZE
+    batch_size: int = 0
+    return_id: bool = False
+
+
+class UpsertTableRecordsRequest(BaseModel):
+    schema_name: str = 'public'
+    table_name: str
+    data: List[dict] = []
+    # columns overwritten when the primary key already exists, empty means every column the row carries
+    update_columns: List[str] = []
+    # 0 means GENAPI_BULK_BATCH_SIZE
+    batch_size: int = 0
+    return_id: bool = False
+
+
+class BulkUpdateTableRecordsRequest(BaseModel):
+    schema_name: str = 'public'
+    table_name: str
+    # partial records, each has to carry every primary key column
+    data: List[dict] = []
+    # 0 means GENAPI_BULK_BATCH_SIZE
+    batch_size: int = 0
@@ -1,21 +1,36 @@
+import logging
+import re
 from abc import ABC
+from typing import AsyncIterator, Tuple, Union
+import asyncpg
+import orjson
 from sqlalchemy import text
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
-from pkg.conn.database import engine
-from core.entity.catalog import GetTableColumnsRequest, GetTableDataRequest, GetTableAttributesRequest, CreateTableRecordRequest, Condition
-from core.repository.catalog_repository.query_parser import QueryParser
+from sqlalchemy.ext.asyncio import AsyncSession
+from config.config import GUNICORN_CONFIG
+from pkg.cache.catalog_cache import catalog_cache, CACHE_COLUMNS, CACHE_PRIMARY_KEY, CACHE_FOREIGN_KEYS, CACHE_SEARCH_INDEXES
+from core.entity.catalog import GetTableColumnsRequest, GetTableDataRequest, GetTableAttributesRequest, CreateTableRecordRequest, BulkCreateTableRecordRequest, UpsertTableRecordsRequest, BulkUpdateTableRecordsRequest, AggregateTableDataRequest, Condition, COLUMN_NAME, FOREIGN_TABLE_SCHEMA, FOREIGN_TABLE_NAME, FOREIGN_COLUMN_NAME, EXPAND_LATERAL, PAGINATION_KEYSET, BULK_COPY, MAX_BIND_PARAMS, SERIALIZATION_DATABASE, COUNT_EXACT, COUNT_ESTIMATED, COUNT_CAPPED, SEARCH_FULLTEXT, SEARCH_TRIGRAM, SEARCH_SEQUENTIAL
+from core.repository.catalog_repository.query_parser import QueryParser, table_fields, AGGREGATE_FUNCTIONS, NUMERIC_AGGREGATES, NUMERIC_TYPES, SORT_DIRECTIONS, TRIGRAM_OPERATOR_CLASSES
+from pkg.helper.type_coercion import coerce_value, coerce_record, key_value, TEXT_UDT_NAMES
+from pkg.helper.cursor import encode_cursor, decode_cursor
+from pkg.guard.query_guard import query_guard
+from pkg.monitor.metrics import bind_shape, confirm_table
+from pkg.monitor.profiler import profiled, KIND_CATALOG
+
+
+logger = logging.getLogger(__name__)
 
 
 class CatalogRepository(ABC):
-    def __init__(self) -> None:
+    def __init__(self, session: AsyncSession) -> None:
         super().__init__()
 
         self.QueryParser = QueryParser()
+        self.session = session
+        # (column, operator) of the last filter compiled against the catalog, for the filter usage statistics
+        self.filter_conditions = []
 
-        _session = sessionmaker(bind=engine)
-        self.session = _session()
-
+    @profiled(KIND_CATALOG)
     async def get_primary_key(self, req: GetTableAttributesRequest):
         if '.' in req.table_name:
             schema_name, table_name = req.table_name.split('.')
@@ -23,6 +38,13 @@ class CatalogRepository(ABC):
             schema_name = req.schema_name
             table_name = req.table_name
 
+        cached = catalog_cache.get(schema_name, table_name, CACHE_PRIMARY_KEY)
+        if cached is not None:
+            if cached:
+                confirm_table(schema_name, table_name)
+
+            return cached
+
         query = text(f'''
             SELECT               
               pg_attribute.attname, 
@@ -36,7 +58,7 @@ class CatalogRepository(ABC):
               pg_attribute.attnum = any(pg_index.indkey)
              AND indisprimary
         ''')
-        result_proxy = self.session.execute(query)
+        result_proxy = await self.session.execute(query)
 
         # Get the column names from the ResultProxy
         column_names = result_proxy.keys()
@@ -45,18 +67,35 @@ class CatalogRepository(ABC):
         rows = result_proxy.fetchall()
 
         # Convert each tuple to a dictionary using the column names as keys
-        return [dict(zip(column_names, row)) for row in rows]
+        primary_key = [dict(zip(column_names, row)) for row in rows]
+        # the regclass cast fails for a table that does not exist, an empty key belongs to a real table
+        catalog_cache.set(schema_name, table_name, CACHE_PRIMARY_KEY, primary_key)
+        if primary_key:
+            confirm_table(schema_name, table_name)
+
+        return primary_key
 
+    @profiled(KIND_CATALOG)
     async def get_table_columns(self, req: GetTableColumnsRequest):
-        select_column = "ordinal_position, column_name, is_nullable, data_type"
+        # only the short attribute list is cached, complete_attribute is a rare debugging call
+        if not req.complete_attribute:
+            cached = catalog_cache.get(req.schema_name, req.table_name, CACHE_COLUMNS)
+            if cached is not None:
+                if cached:
+                    confirm_table(req.schema_name, req.table_name)
+
+                return cached
+
+        select_column = "ordinal_position, column_name, is_nullable, data_type, udt_schema, udt_name"
         if req.complete_attribute:
             select_column = "*"
 
         query = text(f'''SELECT {select_column} 
                         FROM information_schema.columns 
-                        WHERE table_name = :table_name 
+                        WHERE table_schema = :schema_name 
+                            AND table_name = :table_name 
                         ORDER BY ordinal_position''')
-        result_proxy = self.session.execute(query, {'table_name': req.table_name})
+        result_proxy = await self.session.execute(query, {'schema_name': req.schema_name, 'table_name': req.table_name})
 
         # Get the column names from the ResultProxy
         column_names = result_proxy.keys()
@@ -65,8 +104,16 @@ class CatalogRepository(ABC):
         rows = result_proxy.fetchall()
 
         # Convert each tuple to a dictionary using the column names as keys
-        return [dict(zip(column_names, row)) for row in rows]
+        columns = [dict(zip(column_names, row)) for row in rows]
+        # no columns means no such table, caching that would let random table names fill the cache
+        if columns:
+            if not req.complete_attribute:
+                catalog_cache.set(req.schema_name, req.table_name, CACHE_COLUMNS, columns)
+            confirm_table(req.schema_name, req.table_name)
 
+        return columns
+
+    @profiled(KIND_CATALOG)
     async def get_table_foreign_keys(self, req: GetTableColumnsRequest):
         if '.' in req.table_name:
             schema_name, table_name = req.table_name.split('.')
@@ -74,6 +121,10 @@ class CatalogRepository(ABC):
             schema_name = req.schema_name
             table_name = req.table_name
 
+        cached = catalog_cache.get(schema_name, table_name, CACHE_FOREIGN_KEYS)
+        if cached is not None:
+            return cached
+
         query = text(f'''SELECT
                             tc.table_schema, 
                             tc.constraint_name, 
@@ -91,7 +142,7 @@ class CatalogRepository(ABC):
                         WHERE tc.constraint_type = 'FOREIGN KEY'
                             AND tc.table_schema=:schema_name
                             AND tc.table_name=:table_name''')
-        result_proxy = self.session.execute(query, {'schema_name': schema_name, 'table_name': table_name})
+        result_proxy = await self.session.execute(query, {'schema_name': schema_name, 'table_name': table_name})
 
         # Get the column names from the ResultProxy
         column_names = result_proxy.keys()
@@ -99,10 +150,210 @@ class CatalogRepository(ABC):
         # Fetch all rows as a list of tuples
         rows = result_proxy.fetchall()
 
-        print("rows", rows)
-
         # Convert each tuple to a dictionary using the column names as keys
-        return [dict(zip(column_names, row)) for row in rows]
+        foreign_keys = [dict(zip(column_names, row)) for row in rows]
+        # an empty list is only cached for a table the cache already knows, the table may not exist
+        if foreign_keys or catalog_cache.has_table(schema_name, table_name):
+            catalog_cache.set(schema_name, table_name, CACHE_FOREIGN_KEYS, foreign_keys)
+
+        return foreign_keys
+
+    @profiled(KIND_CATALOG)
+    async def get_search_indexes(self, schema_name: str, table_name: str) -> dict:
+        cached = catalog_cache.get(schema_name, table_name, CACHE_SEARCH_INDEXES)
+        if cached is not None:
+            return cached
+
+        # columns covered by a trigram index, one key column at a time
+        query = text('''SELECT a.attname
+                        FROM pg_index i
+                        CROSS JOIN LATERAL unnest(i.indkey::int2[], i.indclass::oid[]) AS k(attnum, opclass)
+                        JOIN pg_opclass oc ON oc.oid = k.opclass
+                        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                        WHERE i.indrelid = to_regclass(:table_name)
+                            AND oc.opcname = ANY(:operator_classes)''')
+        result_proxy = await self.session.execute(query, {'table_name': f'{schema_name}.{table_name}', 'operator_classes': sorted(TRIGRAM_OPERATOR_CLASSES)})
+        trigram_columns = sorted(set(result_proxy.scalars().all()))
+
+        # expressions of gin indexes over to_tsvector, a search repeating the expression can use the index
+        query = text('''SELECT pg_get_expr(i.indexprs, i.indrelid)
+                        FROM pg_index i
+                        JOIN pg_class c ON c.oid = i.indexrelid
+                        JOIN pg_am am ON am.oid = c.relam
+                        WHERE i.indrelid = to_regclass(:table_name)
+                            AND am.amname = 'gin'
+                            AND i.indexprs IS NOT NULL
+                            AND pg_get_expr(i.indexprs, i.indrelid) LIKE 'to_tsvector(%'
+                        ORDER BY c.relname''')
+        result_proxy = await self.session.execute(query, {'table_name': f'{schema_name}.{table_name}'})
+        fulltext_expressions = list(result_proxy.scalars().all())
+
+        search_indexes = {SEARCH_TRIGRAM: trigram_columns, SEARCH_FULLTEXT: fulltext_expressions}
+        if trigram_columns or fulltext_expressions or catalog_cache.has_table(schema_name, table_name):
+            catalog_cache.set(schema_name, table_name, CACHE_SEARCH_INDEXES, search_indexes)
+
+        return search_indexes
+
+    async def get_search_mode(self, schema_name: str, table_name: str) -> str:
+        search_indexes = await self.get_search_indexes(schema_name, table_name)
+        if search_indexes[SEARCH_FULLTEXT]:
+            return SEARCH_FULLTEXT
+
+        req_attr = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+        text_columns = [column[COLUMN_NAME] for column in columns if column['udt_name'] in TEXT_UDT_NAMES]
+
+        # the OR of the ILIKEs only becomes a bitmap index scan when every text column has a trigram index
+        if text_columns and all(column in search_indexes[SEARCH_TRIGRAM] for column in text_columns):
+            return SEARCH_TRIGRAM
+
+        return SEARCH_SEQUENTIAL
+
+    async def get_search_clause(self, schema_name: str, table_name: str, keyword: str) -> Tuple[str, dict]:
+        search_mode = await self.get_search_mode(schema_name, table_name)
+
+        if search_mode == SEARCH_FULLTEXT:
+            # same expression and text search configuration as the index
+            expression = (await self.get_search_indexes(schema_name, table_name))[SEARCH_FULLTEXT][0]
+            config = re.match(r"to_tsvector\('([^']+)'::regconfig", expression)
+            config = config.group(1) if config else 'simple'
+
+            return f"{expression} @@ websearch_to_tsquery('{config}', :keyword)", {'keyword': keyword}
+
+        req_attr = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+        text_columns = [column[COLUMN_NAME] for column in columns if column['udt_name'] in TEXT_UDT_NAMES]
+
+        # a table without text columns has nothing a keyword could match
+        if not text_columns:
+            return 'FALSE', {}
+
+        if search_mode == SEARCH_SEQUENTIAL:
+            logger.warning("keyword search on %s.%s falls back to a sequential scan, no trigram index on every text column", schema_name, table_name)
+
+        # the keyword is matched literally, LIKE wildcards in it are escaped
+        pattern = keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        search_clause = '(' + ' OR '.join(f'{column} ILIKE :keyword' for column in text_columns) + ')'
+
+        return search_clause, {'keyword': f'%{pattern}%'}
+
+    async def get_filter_clauses(self, schema_name: str, table_name: str, req: Union[GetTableDataRequest, AggregateTableDataRequest]) -> Tuple[list[str], dict]:
+        where_clauses, params = [], {}
+
+        if req.query:
+            # first we need to check if column in query exist in table, if not, we will ignore it
+            req_attr = GetTableColumnsRequest(
+                schema_name=schema_name,
+                table_name=table_name
+            )
+            columns = await self.get_table_columns(req_attr)
+
+            # compile the filter into parameterized sql, the values are bound separately
+            where_clauses, params = self.QueryParser.audition_filter_columns(columns, req.query)
+            self.filter_conditions = self.QueryParser.used_conditions(req.query)
+
+        if req.keyword:
+            search_clause, search_params = await self.get_search_clause(schema_name, table_name, req.keyword)
+            where_clauses = where_clauses + [search_clause]
+            params.update(search_params)
+
+        bind_shape(where_clauses)
+
+        return where_clauses, params
+
+    async def get_select_list(self, schema_name: str, table_name: str, fields: list[str], required: list[str] = []) -> str:
+        if not fields:
+            return '*'
+
+        req_attr = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+
+        # foreign key columns stay in the projection, the expansion follows them
+        foreign_keys = await self.get_table_foreign_keys(req_attr)
+        required = list(required) + [foreign_key[COLUMN_NAME] for foreign_key in foreign_keys]
+
+        return self.QueryParser.audition_select_columns(columns, fields, required)
+
+    async def wrap_lateral(self, schema_name: str, table_name: str, query: str, order_by: list[str], fields: list[str]) -> str:
+        req_foreign = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        foreign_keys = await self.get_table_foreign_keys(req_foreign)
+
+        # every referenced row is joined as a jsonb object under the foreign table name, like the python stitching does
+        joins = []
+        objects = []
+        for index, foreign_key in enumerate(foreign_keys):
+            select_list = await self.get_select_list(
+                foreign_key[FOREIGN_TABLE_SCHEMA],
+                foreign_key[FOREIGN_TABLE_NAME],
+                table_fields(fields, foreign_key[FOREIGN_TABLE_NAME]),
+                [foreign_key[FOREIGN_COLUMN_NAME]]
+            )
+            joins.append(f'''LEFT JOIN LATERAL (
+                                SELECT to_jsonb(r) AS obj
+                                FROM (SELECT {select_list} FROM {foreign_key[FOREIGN_TABLE_SCHEMA]}.{foreign_key[FOREIGN_TABLE_NAME]}) r
+                                WHERE r.{foreign_key[FOREIGN_COLUMN_NAME]} = t.{foreign_key[COLUMN_NAME]}
+                                LIMIT 1
+                            ) fk{index} ON true''')
+            objects.append(f"'{foreign_key[FOREIGN_TABLE_NAME]}', COALESCE(fk{index}.obj, '{{}}'::jsonb)")
+
+        record = 'to_jsonb(t)'
+        if objects:
+            record = record + f" || jsonb_build_object({', '.join(objects)})"
+
+        # the page is cut first so the lateral lookups only run for the rows we return
+        query = f"SELECT {record} AS record FROM ({query}) t " + ' '.join(joins)
+        if order_by:
+            query = query + ' ORDER BY ' + ', '.join(f't.{column}' for column in order_by)
+
+        return query
+
+    async def serialize_in_database(self, schema_name: str, table_name: str, req: GetTableDataRequest) -> bool:
+        if req.serialization != SERIALIZATION_DATABASE:
+            return False
+
+        # the python expansion needs the rows as dicts, unless there is nothing to expand
+        if req.expand_mode == EXPAND_LATERAL or req.expand_depth <= 0:
+            return True
+
+        req_foreign = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        return not await self.get_table_foreign_keys(req_foreign)
+
+    async def build_page_query(self, schema_name: str, table_name: str, req: GetTableDataRequest) -> Tuple[str, dict]:
+        select_list = await self.get_select_list(schema_name, table_name, table_fields(req.fields))
+        query = f'''SELECT {select_list} FROM {schema_name}.{table_name}'''
+
+        # generate query based on req.Query
+        where_clauses, params = await self.get_filter_clauses(schema_name, table_name, req)
+
+        # check if where_clauses is not empty
+        if where_clauses:
+            query = query + ' WHERE ' + ' AND '.join(where_clauses)
+
+        # implement pagination, bound like the filter values so every page shares one statement text
+        if req.page and req.page_size:
+            query = query + ' LIMIT :page_limit OFFSET :page_offset'
+            params['page_limit'] = req.page_size
+            params['page_offset'] = (req.page - 1) * req.page_size
+
+        if req.expand_mode == EXPAND_LATERAL:
+            query = await self.wrap_lateral(schema_name, table_name, query, [], req.fields)
+
+        return query, params
 
     async def get_table_data(self, req: GetTableDataRequest):
         try:
@@ -112,33 +363,22 @@ class CatalogRepository(ABC):
                 schema_name = req.schema_name
                 table_name = req.table_name
 
-            query = f'''SELECT * FROM {schema_name}.{table_name}'''
+            query, params = await self.build_page_query(schema_name, table_name, req)
 
-            # generate query based on req.Query
-            if req.query:
-                # first we need to check if column in query exist in table, if not, we will ignore it
-                req_attr = GetTableColumnsRequest(
-                    schema_name=schema_name,
-                    table_name=table_name
-                )
-                columns = await self.get_table_columns(req_attr)
-
-                # get column names
-                column_names = [column['column_name'] for column in columns]
+            if await self.serialize_in_database(schema_name, table_name, req):
+                # postgres renders the whole page as one json array, no python object is built per row
+                record = 'p.record' if req.expand_mode == EXPAND_LATERAL else 'p'
+                query = f"SELECT coalesce(json_agg({record}), '[]')::text FROM ({query}) p"
 
-                # filter query based on column names
-                where_clauses = self.QueryParser.audition_filter_columns(column_names, req.query)
+                result_proxy = await self.session.execute(text(query), params)
+                return result_proxy.scalar_one().encode()
 
-                # check if where_clauses is not empty
-                if where_clauses:
-                    query = query + ' WHERE ' + ' AND '.join(where_clauses)
+            if req.expand_mode == EXPAND_LATERAL:
+                # every row already is the finished json object
+                result_proxy = await self.session.execute(text(query), params)
+                return result_proxy.scalars().all()
 
-            # implement pagination
-            if req.page and req.page_size:
-                # append limit and offset
-                query = query + f' LIMIT {req.page_size} OFFSET {(req.page - 1) * req.page_size}'
-
-            result_proxy = self.session.execute(text(query))
+            result_proxy = await self.session.execute(text(query), params)
 
             # Get the column names from the ResultProxy
             column_names = result_proxy.keys()
@@ -149,59 +389,555 @@ class CatalogRepository(ABC):
             # Convert each tuple to a dictionary using the column names as keys
             return [dict(zip(column_names, row)) for row in rows]
         except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
             # Return the error message as a response
             return {'error': str(e)}
 
-    async def get_table_data_by_id(self, req: GetTableDataRequest):
-        if '.' in req.table_name:
-            schema_name, table_name = req.table_name.split('.')
-        else:
-            schema_name = req.schema_name
-            table_name = req.table_name
+    async def explain(self, query: str, params: dict, analyze: bool = False) -> dict:
+        # without analyze only the planner runs, the statement itself is not executed
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        result_proxy = await self.session.execute(text(f'EXPLAIN ({options}) {query}'), params)
 
-        # return error if id is not provided
-        if req.id is None and req.is_composite_primary_key is False:
-            return {'error': 'ID value is required'}
+        plan = result_proxy.scalar_one()
+        if isinstance(plan, str):
+            plan = orjson.loads(plan)
 
-        if len(req.ids) == 0 and req.is_composite_primary_key is True:
-            return {'error': 'IDs value is required'}
+        return plan[0]
 
-        # get primary key name
-        primary_key_names = req.primary_key_name
+    async def explain_plan(self, query: str, params: dict) -> dict:
+        return (await self.explain(query, params))['Plan']
 
-        # Prepare the WHERE clause for the query
-        if req.is_composite_primary_key:
-            # For composite keys, create a list of conditions and join them with AND
-            conditions = [f"{key} = :{key}" for key in primary_key_names]
-            where_clause = " AND ".join(conditions)
-        else:
-            # For single keys, just use the key name
-            if req.custom_column is not None:
-                primary_key_names = [req.custom_column]
+    async def explain_table_data(self, req: GetTableDataRequest, analyze: bool):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
 
-            where_clause = f"{primary_key_names[0]} = :id"
+            # exactly the statement POST /data/table would run for this request
+            if req.pagination == PAGINATION_KEYSET:
+                built = await self.build_keyset_query(schema_name, table_name, req)
 
-        query = text(f'''SELECT * 
-                        FROM {schema_name}.{table_name} 
-                        WHERE {where_clause}
-                        LIMIT 1''')
+                # check if built return error
+                if isinstance(built, dict):
+                    return built
 
-        # Execute the query
-        if req.is_composite_primary_key:
-            # For composite keys, pass the ids dictionary directly
-            result_proxy = self.session.execute(query, req.ids)
-        else:
-            # For single keys, pass a dictionary with the id
-            result_proxy = self.session.execute(query, {'id': req.id})
+                query, params, _ = built
+            else:
+                query, params = await self.build_page_query(schema_name, table_name, req)
 
-        # Get the column names from the ResultProxy
-        column_names = result_proxy.keys()
+            return {'query': query, 'plan': await self.explain(query, params, analyze)}
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
 
-        # get the first row
-        row = result_proxy.fetchone()
+            # Return the error message as a response
+            return {'error': str(e)}
 
-        # Convert each tuple to a dictionary using the column names as keys
-        return dict(zip(column_names, row))
+    async def estimate_statement(self, schema_name: str, table_name: str, query: str, params: dict) -> Tuple[float, float]:
+        # values, limits and offsets are all bound, the statement text is the filter shape and keys the estimate;
+        # the first values seen for a shape decide its plan, the way a generic prepared plan would
+        estimate = query_guard.get(schema_name, table_name, query)
+        if estimate is None:
+            estimate = query_guard.set(schema_name, table_name, query, await self.explain_plan(query, params))
+
+        return estimate
+
+    async def estimate_table_data(self, req: GetTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            if req.pagination == PAGINATION_KEYSET:
+                built = await self.build_keyset_query(schema_name, table_name, req)
+
+                # check if built return error
+                if isinstance(built, dict):
+                    return built
+
+                query, params, _ = built
+            else:
+                query, params = await self.build_page_query(schema_name, table_name, req)
+
+            return await self.estimate_statement(schema_name, table_name, query, params)
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def get_index_leading_columns(self, schema_name: str, table_name: str) -> dict:
+        # column -> [(access method, operator class)] of every index the column leads
+        query = text('''SELECT a.attname, am.amname, oc.opcname
+                        FROM pg_index i
+                        JOIN pg_class c ON c.oid = i.indexrelid
+                        JOIN pg_am am ON am.oid = c.relam
+                        CROSS JOIN LATERAL unnest(i.indkey::int2[], i.indclass::oid[]) WITH ORDINALITY AS k(attnum, opclass, position)
+                        JOIN pg_opclass oc ON oc.oid = k.opclass
+                        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+                        WHERE i.indrelid = to_regclass(:table_name)
+                            AND k.position = 1''')
+        result_proxy = await self.session.execute(query, {'table_name': f'{schema_name}.{table_name}'})
+
+        leading_columns = {}
+        for column_name, access_method, operator_class in result_proxy.fetchall():
+            leading_columns.setdefault(column_name, []).append((access_method, operator_class))
+
+        return leading_columns
+
+    async def build_count_query(self, schema_name: str, table_name: str, req: GetTableDataRequest) -> Tuple[str, dict, bool]:
+        # the same compiled filter as the page itself
+        where_clauses, params = await self.get_filter_clauses(schema_name, table_name, req)
+
+        query = f'''SELECT 1 FROM {schema_name}.{table_name}'''
+        if where_clauses:
+            query = query + ' WHERE ' + ' AND '.join(where_clauses)
+
+        return query, params, bool(where_clauses)
+
+    async def estimate_count_table_data(self, req: GetTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            # an exact count reads every match, the other modes are bounded or only ask the planner
+            query, params, _ = await self.build_count_query(schema_name, table_name, req)
+
+            return await self.estimate_statement(schema_name, table_name, f'SELECT count(*) FROM ({query}) c', params)
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def count_table_data(self, req: GetTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            query, params, filtered = await self.build_count_query(schema_name, table_name, req)
+
+            if req.count == COUNT_EXACT:
+                result_proxy = await self.session.execute(text(f'SELECT count(*) FROM ({query}) c'), params)
+                return result_proxy.scalar_one()
+
+            if req.count == COUNT_ESTIMATED:
+                if not filtered:
+                    # reltuples is kept up to date by vacuum and analyze, -1 means the table was never analyzed
+                    result_proxy = await self.session.execute(
+                        text('SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:table)'),
+                        {'table': f'{schema_name}.{table_name}'}
+                    )
+                    estimate = result_proxy.scalar_one_or_none()
+                    if estimate is not None and estimate >= 0:
+                        return estimate
+
+                plan = await self.explain_plan(query, params)
+                return int(plan['Plan Rows'])
+
+            if req.count == COUNT_CAPPED:
+                count_cap = req.count_cap if req.count_cap > 0 else GUNICORN_CONFIG.COUNT_CAP
+
+                # stop scanning one row past the cap
+                params['count_cap'] = count_cap + 1
+                result_proxy = await self.session.execute(text(f'SELECT count(*) FROM ({query} LIMIT :count_cap) c'), params)
+                count = result_proxy.scalar_one()
+
+                return f'{count_cap}+' if count > count_cap else count
+
+            return {'error': f'Unsupported count mode {req.count}'}
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def build_aggregate_query(self, schema_name: str, table_name: str, req: AggregateTableDataRequest) -> Union[dict, Tuple[str, dict]]:
+        if not req.group_by and not req.aggregates:
+            return {'error': 'group_by or aggregates is required'}
+
+        req_attr = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+        column_types = {column[COLUMN_NAME]: column['data_type'] for column in columns}
+
+        # every name ends up in the sql, so everything is checked against the catalog first
+        for column in req.group_by:
+            if column not in column_types:
+                return {'error': f'{column} is not a column of {schema_name}.{table_name}'}
+
+        select_items = list(req.group_by)
+        aliases = set()
+        for aggregate in req.aggregates:
+            function = aggregate.function.strip().lower()
+            if function not in AGGREGATE_FUNCTIONS:
+                return {'error': f'Unsupported aggregate function {aggregate.function}'}
+
+            if aggregate.column_name == '*':
+                if function != 'count':
+                    return {'error': f'{function} requires a column'}
+            elif aggregate.column_name not in column_types:
+                return {'error': f'{aggregate.column_name} is not a column of {schema_name}.{table_name}'}
+            elif function in NUMERIC_AGGREGATES and column_types[aggregate.column_name] not in NUMERIC_TYPES:
+                return {'error': f'{function} requires a numeric column, {aggregate.column_name} is {column_types[aggregate.column_name]}'}
+
+            alias = aggregate.alias or (function if aggregate.column_name == '*' else f'{function}_{aggregate.column_name}')
+            if not alias.isidentifier() or alias in aliases or alias in req.group_by:
+                return {'error': f'Invalid or duplicate alias {alias}'}
+            aliases.add(alias)
+
+            argument = aggregate.column_name
+            if aggregate.distinct and argument != '*':
+                argument = f'DISTINCT {argument}'
+
+            select_items.append(f'{function}({argument}) AS "{alias}"')
+
+        order_items = []
+        for item in req.order_by:
+            parts = item.split()
+            direction = parts[1].lower() if len(parts) == 2 else 'asc'
+            if not parts or len(parts) > 2 or direction not in SORT_DIRECTIONS or (parts[0] not in req.group_by and parts[0] not in aliases):
+                return {'error': f'Invalid order_by {item}, use a group by column or an aggregate alias'}
+
+            order_items.append(f'"{parts[0]}" {direction.upper()}')
+
+        # the same filter tree as POST /data/table
+        where_clauses, params = await self.get_filter_clauses(schema_name, table_name, req)
+
+        query = f'''SELECT {', '.join(select_items)} FROM {schema_name}.{table_name}'''
+        if where_clauses:
+            query = query + ' WHERE ' + ' AND '.join(where_clauses)
+
+        if req.group_by:
+            query = query + ' GROUP BY ' + ', '.join(req.group_by)
+
+        if order_items:
+            query = query + ' ORDER BY ' + ', '.join(order_items)
+
+        if req.limit > 0:
+            query = query + ' LIMIT :page_limit'
+            params['page_limit'] = req.limit
+
+        return query, params
+
+    async def estimate_aggregate_table_data(self, req: AggregateTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            built = await self.build_aggregate_query(schema_name, table_name, req)
+
+            # check if built return error
+            if isinstance(built, dict):
+                return built
+
+            return await self.estimate_statement(schema_name, table_name, *built)
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def aggregate_table_data(self, req: AggregateTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            built = await self.build_aggregate_query(schema_name, table_name, req)
+
+            # check if built return error
+            if isinstance(built, dict):
+                return built
+
+            query, params = built
+
+            result_proxy = await self.session.execute(text(query), params)
+
+            # Get the column names from the ResultProxy
+            column_names = result_proxy.keys()
+
+            # Convert each tuple to a dictionary using the column names as keys
+            return [dict(zip(column_names, row)) for row in result_proxy.fetchall()]
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def stream_table_data(self, req: GetTableDataRequest, batch_size: int) -> AsyncIterator[Union[list[dict], dict]]:
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            select_list = await self.get_select_list(schema_name, table_name, table_fields(req.fields))
+            query = f'''SELECT {select_list} FROM {schema_name}.{table_name}'''
+
+            where_clauses, params = await self.get_filter_clauses(schema_name, table_name, req)
+            if where_clauses:
+                query = query + ' WHERE ' + ' AND '.join(where_clauses)
+
+            if req.expand_mode == EXPAND_LATERAL:
+                query = await self.wrap_lateral(schema_name, table_name, query, [], req.fields)
+
+            # stream() opens a server-side cursor, only batch_size rows are held in memory at a time
+            result_proxy = await self.session.stream(text(query).execution_options(yield_per=batch_size), params)
+
+            # Get the column names from the ResultProxy
+            column_names = result_proxy.keys()
+
+            async for rows in result_proxy.partitions(batch_size):
+                if req.expand_mode == EXPAND_LATERAL:
+                    yield [row[0] for row in rows]
+                else:
+                    yield [dict(zip(column_names, row)) for row in rows]
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # the error ends the stream, a dict so it cannot be mistaken for a batch of records
+            yield {'error': str(e)}
+
+    async def get_keyset_columns(self, schema_name: str, table_name: str, order_by: list[str]) -> list[str]:
+        req_attr = GetTableAttributesRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        primary_key = await self.get_primary_key(req_attr)
+
+        # the primary key is always appended so the ordering is unique, otherwise rows sharing a value get skipped
+        key_columns = list(order_by)
+        for key in primary_key:
+            if key['attname'] not in key_columns:
+                key_columns.append(key['attname'])
+
+        return key_columns
+
+    async def build_keyset_query(self, schema_name: str, table_name: str, req: GetTableDataRequest) -> Union[dict, Tuple[str, dict, list[str]]]:
+        if req.page_size < 1:
+            return {'error': 'page_size must be greater than zero'}
+
+        req_attr = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+        column_types = {column[COLUMN_NAME]: column['data_type'] for column in columns}
+        nullable_columns = {column[COLUMN_NAME] for column in columns if column['is_nullable'] == 'YES'}
+
+        for column in req.order_by:
+            if column not in column_types:
+                return {'error': f'{column} is not a column of {schema_name}.{table_name}'}
+
+            # a row comparison against NULL is NULL, those rows would be skipped and a NULL cursor ends the listing
+            if column in nullable_columns:
+                return {'error': f'{column} is nullable, keyset pagination needs NOT NULL order_by columns'}
+
+        key_columns = await self.get_keyset_columns(schema_name, table_name, req.order_by)
+        if not key_columns:
+            return {'error': 'Keyset pagination requires a primary key or order_by columns'}
+
+        where_clauses, params = await self.get_filter_clauses(schema_name, table_name, req)
+
+        # seek past the last row of the previous page: (a, b) > (:k0, :k1)
+        if req.cursor:
+            try:
+                cursor_columns, cursor_values = decode_cursor(req.cursor)
+            except (ValueError, KeyError, TypeError):
+                return {'error': 'Invalid cursor'}
+
+            if cursor_columns != key_columns or len(cursor_values) != len(key_columns):
+                return {'error': 'Cursor does not match the requested ordering'}
+
+            placeholders = []
+            for index, column in enumerate(key_columns):
+                params[f'k{index}'] = coerce_value(column_types.get(column), cursor_values[index])
+                placeholders.append(f':k{index}')
+
+            where_clauses.append(f"({', '.join(key_columns)}) > ({', '.join(placeholders)})")
+
+        # the key columns are needed for the next cursor
+        select_list = await self.get_select_list(schema_name, table_name, table_fields(req.fields), key_columns)
+        query = f'''SELECT {select_list} FROM {schema_name}.{table_name}'''
+        if where_clauses:
+            query = query + ' WHERE ' + ' AND '.join(where_clauses)
+
+        # one extra row tells us whether there is a next page
+        query = query + f" ORDER BY {', '.join(key_columns)} LIMIT :page_limit"
+        params['page_limit'] = req.page_size + 1
+
+        if req.expand_mode == EXPAND_LATERAL:
+            query = await self.wrap_lateral(schema_name, table_name, query, key_columns, req.fields)
+
+        return query, params, key_columns
+
+    async def get_table_data_keyset(self, req: GetTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            built = await self.build_keyset_query(schema_name, table_name, req)
+
+            # check if built return error
+            if isinstance(built, dict):
+                return built
+
+            query, params, key_columns = built
+
+            result_proxy = await self.session.execute(text(query), params)
+
+            # Get the column names from the ResultProxy
+            column_names = result_proxy.keys()
+
+            # Fetch all rows as a list of tuples
+            rows = result_proxy.fetchall()
+
+            # Convert each tuple to a dictionary using the column names as keys
+            if req.expand_mode == EXPAND_LATERAL:
+                records = [row[0] for row in rows[:req.page_size]]
+            else:
+                records = [dict(zip(column_names, row)) for row in rows[:req.page_size]]
+
+            next_cursor = None
+            if len(rows) > req.page_size:
+                last_record = records[-1]
+                next_cursor = encode_cursor(key_columns, [last_record[column] for column in key_columns])
+
+            return {'data': records, 'next_cursor': next_cursor}
+        except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
+            # Return the error message as a response
+            return {'error': str(e)}
+
+    async def get_table_data_by_id(self, req: GetTableDataRequest):
+        try:
+            if '.' in req.table_name:
+                schema_name, table_name = req.table_name.split('.')
+            else:
+                schema_name = req.schema_name
+                table_name = req.table_name
+
+            # a single id returns the record itself, a list of ids returns one entry per requested id
+            ids = [req.id] if req.id is not None else req.ids
+
+            # return error if neither id nor ids is provided
+            if not ids:
+                return {'error': 'ID value is required'}
+
+            req_attr = GetTableColumnsRequest(
+                schema_name=schema_name,
+                table_name=table_name
+            )
+            columns = await self.get_table_columns(req_attr)
+            column_types = {column[COLUMN_NAME]: column['data_type'] for column in columns}
+            array_types = {column[COLUMN_NAME]: f'"{column["udt_schema"]}"."{column["udt_name"]}"[]' for column in columns}
+
+            # the primary key is the lookup key unless a custom column is given
+            key_columns = req.primary_key_name
+            if req.custom_column:
+                if req.custom_column not in column_types:
+                    return {'error': f'Column {req.custom_column} does not exist'}
+
+                key_columns = [req.custom_column]
+
+            if not key_columns:
+                return {'error': 'Primary key is required'}
+
+            # every id becomes a tuple typed after the key columns, composite keys are given as dicts
+            keys = []
+            for id in ids:
+                if isinstance(id, dict) and all(column in id for column in key_columns):
+                    values = [id[column] for column in key_columns]
+                elif not isinstance(id, dict) and len(key_columns) == 1:
+                    values = [id]
+                else:
+                    keys.append(None)
+                    continue
+
+                keys.append(tuple(coerce_value(column_types[column], value) for column, value in zip(key_columns, values)))
+
+            # matched on normalized values, the bound values stay as coerced
+            match_keys = [tuple(key_value(value) for value in key) if key is not None else None for key in keys]
+            unique_keys = list(dict.fromkeys(key for key in keys if key is not None))
+
+            records = {}
+            if unique_keys:
+                if len(key_columns) == 1:
+                    where_clause = f"{key_columns[0]} = ANY(:k0)"
+                else:
+                    # one array per key column, unnest zips them back into key tuples
+                    arrays = ', '.join(f'CAST(:k{index} AS {array_types[column]})' for index, column in enumerate(key_columns))
+                    where_clause = f"({', '.join(key_columns)}) IN (SELECT * FROM unnest({arrays}))"
+
+                # the key columns are needed to match the rows back to the requested ids
+                select_list = await self.get_select_list(schema_name, table_name, table_fields(req.fields), key_columns)
+                query = text(f'''SELECT {select_list} 
+                                FROM {schema_name}.{table_name} 
+                                WHERE {where_clause}''')
+                params = {f'k{index}': [key[index] for key in unique_keys] for index in range(len(key_columns))}
+                result_proxy = await self.session.execute(query, params)
+
+                # Get the column names from the ResultProxy
+                column_names = result_proxy.keys()
+
+                # a custom column may match several rows, the first one wins like the former LIMIT 1
+                for row in result_proxy.fetchall():
+                    record = dict(zip(column_names, row))
+                    records.setdefault(tuple(key_value(record[column]) for column in key_columns), record)
+
+            if req.id is not None:
+                record = records.get(match_keys[0]) if match_keys[0] is not None else None
+                if record is None:
+                    return {'error': 'Record not found'}
+
+                return record
+
+            # keep the request order, missing and malformed keys are reported in place
+            results = []
+            for id, key in zip(ids, match_keys):
+                if key is None:
+                    results.append({'id': id, 'found': False, 'error': f"Key {', '.join(key_columns)} is required"})
+                    continue
+
+                record = records.get(key)
+                results.append({'id': id, 'found': record is not None, 'data': record})
+
+            return results
+        except SQLAlchemyError as e:
+            await self.session.rollback()
+            return {'error': str(e)}
 
     async def get_table_data_by_ids(self, req: GetTableDataRequest):
         try:
@@ -215,22 +951,35 @@ class CatalogRepository(ABC):
             if not req.ids:
                 return {'error': 'IDs value is required'}
 
-            # get primary key first
-            req_attr = GetTableAttributesRequest(
+            # the lookup column normally comes from the foreign key metadata, the primary key is the fallback
+            if req.custom_column:
+                key_column = req.custom_column
+            else:
+                req_attr = GetTableAttributesRequest(
+                    schema_name=schema_name,
+                    table_name=table_name
+                )
+                primary_key = await self.get_primary_key(req_attr)
+                if not primary_key:
+                    return {'error': 'Primary key is required'}
+
+                key_column = primary_key[0]['attname']
+
+            req_columns = GetTableColumnsRequest(
                 schema_name=schema_name,
                 table_name=table_name
             )
-            primary_key = await self.get_primary_key(req_attr)
+            columns = await self.get_table_columns(req_columns)
+            column_types = {column[COLUMN_NAME]: column['data_type'] for column in columns}
 
-            # get primary key name
-            primary_key_name = primary_key[0]['attname']
-            if req.custom_column:
-                primary_key_name = req.custom_column
+            # one array parameter instead of an inlined tuple, duplicates removed
+            ids = [coerce_value(column_types.get(key_column), id) for id in dict.fromkeys(req.ids)]
 
-            query = text(f'''SELECT * 
+            select_list = await self.get_select_list(schema_name, table_name, req.fields, [key_column])
+            query = text(f'''SELECT {select_list} 
                             FROM {schema_name}.{table_name} 
-                            WHERE {primary_key_name} IN {tuple(req.ids)}''')
-            result_proxy = self.session.execute(query)
+                            WHERE {key_column} = ANY(:ids)''')
+            result_proxy = await self.session.execute(query, {'ids': ids})
 
             # Get the column names from the ResultProxy
             column_names = result_proxy.keys()
@@ -242,6 +991,9 @@ class CatalogRepository(ABC):
             return [dict(zip(column_names, row)) for row in rows]
 
         except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
             # Return the error message as a response
             return {'error': str(e)}
 
@@ -254,6 +1006,7 @@ class CatalogRepository(ABC):
             columns = await self.get_table_columns(req_attr)
 
             req.data = self.QueryParser.audition_insert_column(columns, req.data)
+            params = coerce_record(columns, req.data)
 
             # Prepare the SQL INSERT statement
             columns = ', '.join(req.data.keys())
@@ -263,10 +1016,7 @@ class CatalogRepository(ABC):
                                  VALUES ({placeholders}) RETURNING *''')
 
             # Execute the query
-            result_proxy = self.session.execute(query, req.data)
-
-            # commit session
-            self.session.commit()
+            result_proxy = await self.session.execute(query, params)
 
             # Get the column names from the ResultProxy
             column_names = result_proxy.keys()
@@ -274,6 +1024,9 @@ class CatalogRepository(ABC):
             # Fetch the inserted row
             row = result_proxy.fetchone()
 
+            # commit session
+            await self.session.commit()
+
             # Convert the row to a dictionary using the column names as keys
             inserted_record = dict(zip(column_names, row))
 
@@ -285,6 +1038,9 @@ class CatalogRepository(ABC):
             return inserted_record
 
         except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
             # Return the error message as a response
             return {'error': str(e)}
 
@@ -307,10 +1063,7 @@ class CatalogRepository(ABC):
                             RETURNING *''')
 
             # Execute the query
-            result_proxy = self.session.execute(query, req.data)
-
-            # commit session
-            self.session.commit()
+            result_proxy = await self.session.execute(query, coerce_record(columns, req.data))
 
             # Get the column names from the ResultProxy
             column_names = result_proxy.keys()
@@ -318,9 +1071,274 @@ class CatalogRepository(ABC):
             # Fetch the updated row
             row = result_proxy.fetchone()
 
+            # commit session
+            await self.session.commit()
+
             # Convert the row to a dictionary using the column names as keys
             return dict(zip(column_names, row))
 
         except SQLAlchemyError as e:
+            # the transaction is aborted, roll it back so the session stays usable
+            await self.session.rollback()
+
             # Return the error message as a response
-            return {'error': str(e)}
\ No newline at end of file
+            return {'error': str(e)}
+
+    def bulk_batch_size(self, requested: int, column_count: int) -> int:
+        batch_size = requested or GUNICORN_CONFIG.BULK_BATCH_SIZE
+
+        # a multi-row VALUES statement binds one parameter per cell
+        return max(min(batch_size, MAX_BIND_PARAMS // max(column_count, 1)), 1)
+
+    def prepare_bulk_rows(self, columns: list[dict], records: list[tuple[int, dict]], failed: list[dict]) -> list[tuple[int, dict]]:
+        # validate every record against the cached column set once, up front
+        rows = []
+        for index, data in records:
+            data = self.QueryParser.audition_insert_column(columns, dict(data))
+            if not data:
+                failed.append({'index': index, 'error': 'Record has no known column'})
+                continue
+
+            rows.append((index, coerce_record(columns, data)))
+
+        return rows
+
+    async def insert_records(self, schema_name: str, table_name: str, rows: list[tuple[int, dict]], returning: list[str], on_conflict: str = '') -> list:
+        # the union of the keys of the batch, cells a row does not have fall back to the column default
+        column_names = list(dict.fromkeys(key for _, row in rows for key in row))
+
+        params = {}
+        values = []
+        for row_index, (_, row) in enumerate(rows):
+            cells = []
+            for column_index, column in enumerate(column_names):
+                if column in row:
+                    params[f'r{row_index}_{column_index}'] = row[column]
+                    cells.append(f':r{row_index}_{column_index}')
+                else:
+                    cells.append('DEFAULT')
+            values.append(f"({', '.join(cells)})")
+
+        query = f'''INSERT INTO {schema_name}.{table_name} ({', '.join(column_names)})
+                        VALUES {', '.join(values)} {on_conflict}'''
+        if not returning:
+            await self.session.execute(text(query), params)
+            return []
+
+        query = query + f" RETURNING {', '.join(returning)}"
+        result_proxy = await self.session.execute(text(query), params)
+        returned = [row[0] if len(returning) == 1 else dict(zip(returning, row)) for row in result_proxy.fetchall()]
+
+        # every id is paired with the index of its input record, so a partial failure does not shift them
+        if len(returned) == len(rows):
+            # postgres returns the rows of a multi-row VALUES in input order
+            return [{'index': index, 'id': id} for (index, _), id in zip(rows, returned)]
+
+        # ON CONFLICT DO NOTHING skipped some rows, the returned keys are matched to the input keys instead
+        indexes = {}
+        for index, row in rows:
+            if all(column in row for column in returning):
+                indexes.setdefault(tuple(key_value(row[column]) for column in returning), index)
+
+        ids = []
+        for id in returned:
+            key = tuple(key_value(value) for value in (id.values() if isinstance(id, dict) else [id]))
+            if key in indexes:
+                ids.append({'index': indexes[key], 'id': id})
+
+        return ids
+
+    async def copy_records(self, schema_name: str, table_name: str, rows: list[tuple[int, dict]]) -> list:
+        # binary COPY straight through the asyncpg connection behind the session
+        connection = await self.session.connection()
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        # COPY takes a fixed column list, so rows are grouped by the keys they carry
+        groups = {}
+        for _, row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(tuple(row.values()))
+
+        # the adapter only begins its transaction on the first statement, right after a commit the COPYs would
+        # each commit on their own; the explicit transaction (a savepoint when one is open) keeps the batch atomic
+        async with driver_connection.transaction():
+            for column_names, records in groups.items():
+                await driver_connection.copy_records_to_table(
+                    table_name,
+                    schema_name=schema_name,
+                    columns=list(column_names),
+                    records=records
+                )
+
+        return []
+
+    async def load_in_batches(self, rows: list[tuple[int, dict]], batch_size: int, load_batch) -> Tuple[int, list, list[dict]]:
+        loaded = 0
+        ids = []
+        failed = []
+
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            try:
+                ids.extend(await load_batch(batch))
+
+                # commit per batch, a later failure does not undo what is already loaded
+                await self.session.commit()
+                loaded += len(batch)
+            except (SQLAlchemyError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                # the transaction is aborted, roll it back so the session stays usable
+                await self.session.rollback()
+
+                # retry the batch row by row, each in its own savepoint, to find the rows that fail
+                for row in batch:
+                    try:
+                        async with self.session.begin_nested():
+                            ids.extend(await load_batch([row]))
+                        loaded += 1
+                    except (SQLAlchemyError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                        failed.append({'index': row[0], 'error': str(e)})
+
+                await self.session.commit()
+
+        return loaded, ids, failed
+
+    async def create_table_records(self, req: BulkCreateTableRecordRequest, records: list[tuple[int, dict]], primary_key_columns: list[str]) -> dict:
+        req_attr = GetTableColumnsRequest(
+            schema_name=req.schema_name,
+            table_name=req.table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+
+        failed = []
+        rows = self.prepare_bulk_rows(columns, records, failed)
+
+        returning = primary_key_columns if req.return_id else []
+
+        async def load_batch(batch):
+            if req.method == BULK_COPY and not returning:
+                return await self.copy_records(req.schema_name, req.table_name, batch)
+
+            return await self.insert_records(req.schema_name, req.table_name, batch, returning)
+
+        batch_size = self.bulk_batch_size(req.batch_size, len(columns))
+        inserted, ids, batch_failed = await self.load_in_batches(rows, batch_size, load_batch)
+
+        return {'inserted': inserted, 'ids': ids, 'failed': sorted(failed + batch_failed, key=lambda failure: failure['index'])}
+
+    async def upsert_table_records(self, req: UpsertTableRecordsRequest, records: list[tuple[int, dict]], primary_key_columns: list[str]) -> dict:
+        req_attr = GetTableColumnsRequest(
+            schema_name=req.schema_name,
+            table_name=req.table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+        column_names = [column[COLUMN_NAME] for column in columns]
+
+        for column in req.update_columns:
+            if column not in column_names:
+                return {'error': f'{column} is not a column of {req.schema_name}.{req.table_name}'}
+
+        failed = []
+        rows = self.prepare_bulk_rows(columns, records, failed)
+
+        # rows carrying the same columns share one statement; a missing cell must not overwrite the stored value
+        groups = {}
+        for index, row in rows:
+            group = groups.setdefault(tuple(row.keys()), {})
+
+            # a batch may not touch the same key twice, the last occurrence wins
+            if all(key in row for key in primary_key_columns):
+                group_key = tuple(row[key] for key in primary_key_columns)
+            else:
+                group_key = ('row', index)
+            group.pop(group_key, None)
+            group[group_key] = (index, row)
+
+        returning = primary_key_columns if req.return_id else []
+        batch_size = self.bulk_batch_size(req.batch_size, len(columns))
+
+        upserted = 0
+        ids = []
+        for row_columns, group in groups.items():
+            update_columns = req.update_columns or [column for column in row_columns if column not in primary_key_columns]
+            update_columns = [column for column in update_columns if column in row_columns and column not in primary_key_columns]
+
+            on_conflict = f"ON CONFLICT ({', '.join(primary_key_columns)}) DO NOTHING"
+            if update_columns:
+                set_clause = ', '.join(f'{column} = EXCLUDED.{column}' for column in update_columns)
+                on_conflict = f"ON CONFLICT ({', '.join(primary_key_columns)}) DO UPDATE SET {set_clause}"
+
+            async def load_batch(batch, on_conflict=on_conflict):
+                return await self.insert_records(req.schema_name, req.table_name, batch, returning, on_conflict)
+
+            group_upserted, group_ids, group_failed = await self.load_in_batches(list(group.values()), batch_size, load_batch)
+            upserted += group_upserted
+            ids.extend(group_ids)
+            failed.extend(group_failed)
+
+        return {'upserted': upserted, 'ids': sorted(ids, key=lambda id: id['index']), 'failed': sorted(failed, key=lambda failure: failure['index'])}
+
+    async def update_table_records(self, req: BulkUpdateTableRecordsRequest, primary_key_columns: list[str]) -> dict:
+        req_attr = GetTableColumnsRequest(
+            schema_name=req.schema_name,
+            table_name=req.table_name
+        )
+        columns = await self.get_table_columns(req_attr)
+
+        # VALUES rows carry no column type, every cell is cast to the exact type of its target column
+        column_types = {column[COLUMN_NAME]: f'"{column["udt_schema"]}"."{column["udt_name"]}"' for column in columns}
+
+        failed = []
+        rows = self.prepare_bulk_rows(columns, list(enumerate(req.data)), failed)
+
+        # records changing the same set of columns are applied by one statement
+        groups = {}
+        for index, row in rows:
+            if not all(key in row for key in primary_key_columns):
+                failed.append({'index': index, 'error': f"Primary key {', '.join(primary_key_columns)} is required"})
+                continue
+
+            changed_columns = tuple(column for column in row if column not in primary_key_columns)
+            if not changed_columns:
+                failed.append({'index': index, 'error': 'Record has no column to update'})
+                continue
+
+            groups.setdefault(changed_columns, []).append((index, row))
+
+        batch_size = self.bulk_batch_size(req.batch_size, len(columns))
+
+        updated = 0
+        records = []
+        for changed_columns, group in groups.items():
+            value_columns = primary_key_columns + list(changed_columns)
+            set_clause = ', '.join(f'{column} = v.{column}' for column in changed_columns)
+            where_clause = ' AND '.join(f't.{column} = v.{column}' for column in primary_key_columns)
+
+            async def load_batch(batch, value_columns=value_columns, set_clause=set_clause, where_clause=where_clause):
+                params = {}
+                values = []
+                for row_index, (_, row) in enumerate(batch):
+                    cells = []
+                    for column_index, column in enumerate(value_columns):
+                        params[f'r{row_index}_{column_index}'] = row[column]
+                        cells.append(f'CAST(:r{row_index}_{column_index} AS {column_types[column]})')
+                    values.append(f"({', '.join(cells)})")
+
+                query = f'''UPDATE {req.schema_name}.{req.table_name} t
+                                SET {set_clause}
+                                FROM (VALUES {', '.join(values)}) AS v({', '.join(value_columns)})
+                                WHERE {where_clause}
+                                RETURNING t.*'''
+                result_proxy = await self.session.execute(text(query), params)
+
+                # Get the column names from the ResultProxy
+                column_names = result_proxy.keys()
+
+                # Convert each tuple to a dictionary using the column names as keys
+                return [dict(zip(column_names, row)) for row in result_proxy.fetchall()]
+
+            _, group_records, group_failed = await self.load_in_batches(group, batch_size, load_batch)
+            updated += len(group_records)
+            records.extend(group_records)
+            failed.extend(group_failed)
+
+        return {'updated': updated, 'records': records, 'failed': sorted(failed, key=lambda failure: failure['index'])}
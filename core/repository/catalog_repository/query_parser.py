@@ -1,14 +1,107 @@
-from abc import ABC, abstractmethod
-from core.entity.catalog import Condition, Query, GetTableColumnsRequest, EMPTY_STRING
-from typing import Union
+from abc import ABC
+from functools import lru_cache
+from itertools import count
+from core.entity.catalog import Condition, Query, COLUMN_NAME
+from config.config import GUNICORN_CONFIG
+from pkg.monitor.profiler import profiled, KIND_PARSE
+from pkg.helper.type_coercion import coerce_value, INTEGER_TYPES, FLOAT_TYPES
+from typing import Union, Tuple
+
+# operators a client may use, mapped to the SQL we emit; anything else is ignored like an unknown column
+OPERATORS = {
+    '=': '=',
+    '!=': '!=',
+    '<>': '<>',
+    '<': '<',
+    '<=': '<=',
+    '>': '>',
+    '>=': '>=',
+    'like': 'LIKE',
+    'not like': 'NOT LIKE',
+    'ilike': 'ILIKE',
+    'not ilike': 'NOT ILIKE',
+    'in': 'IN',
+    'not in': 'NOT IN',
+}
+LIST_OPERATORS = {'IN', 'NOT IN'}
+TEXT_OPERATORS = {'LIKE', 'NOT LIKE', 'ILIKE', 'NOT ILIKE'}
+# negations match most of the table, no index helps them
+NEGATED_OPERATORS = {'!=', '<>', 'NOT IN', 'NOT LIKE', 'NOT ILIKE'}
+TRIGRAM_OPERATOR_CLASSES = {'gin_trgm_ops', 'gist_trgm_ops'}
+
+# aggregate functions a client may use, sum and avg only on numeric columns
+AGGREGATE_FUNCTIONS = {'count', 'sum', 'avg', 'min', 'max'}
+NUMERIC_AGGREGATES = {'sum', 'avg'}
+NUMERIC_TYPES = INTEGER_TYPES | FLOAT_TYPES | {'numeric'}
+SORT_DIRECTIONS = {'asc', 'desc'}
+
+SHAPE_CONDITION = 'c'
+SHAPE_QUERY = 'q'
+# IN lists longer than this are bound as a single array parameter, padding them would run into the bind limit
+MAX_IN_LIST_PLACEHOLDERS = 1024
+ARRAY_ARITY = 'array'
+ARRAY_OPERATORS = {'IN': '= ANY', 'NOT IN': '<> ALL'}
+
+
+def table_fields(fields: list[str], table_name: str = None) -> list[str]:
+    # bare names belong to the requested table, "table.column" to an expanded foreign table
+    if table_name is None:
+        return [field for field in fields if '.' not in field]
+
+    prefix = table_name + '.'
+    return [field[len(prefix):] for field in fields if field.startswith(prefix)]
+
+
+def arity_bucket(size: int) -> int:
+    # IN lists are padded up to the next power of two so a handful of statements covers every list length
+    bucket = 1
+    while bucket < size:
+        bucket *= 2
+
+    return bucket
+
+
+@lru_cache(maxsize=GUNICORN_CONFIG.QUERY_SHAPE_CACHE_SIZE)
+def compile_shape(shape: tuple) -> str:
+    # parameters are numbered in traversal order, the same order QueryParser collects the values in
+    return render_query(shape, count())
+
+
+def render_query(shape: tuple, counter) -> str:
+    _, and_shapes, or_shapes = shape
+
+    and_query = ' AND '.join(render_node(node, counter) for node in and_shapes)
+    or_query = ' OR '.join(render_node(node, counter) for node in or_shapes)
+
+    if and_query and or_query:
+        return f"({and_query}) AND ({or_query})"
+
+    return f"({and_query or or_query})"
+
+
+def render_node(shape: tuple, counter) -> str:
+    if shape[0] == SHAPE_QUERY:
+        return render_query(shape, counter)
+
+    _, column_name, operator, arity = shape
+    if arity is None:
+        return f"{column_name} {operator} :p{next(counter)}"
+
+    if arity == 0:
+        # an empty IN list matches nothing, an empty NOT IN list matches everything
+        return 'FALSE' if operator == 'IN' else 'TRUE'
+
+    if arity == ARRAY_ARITY:
+        return f"{column_name} {ARRAY_OPERATORS[operator]}(:p{next(counter)})"
+
+    placeholders = ', '.join(f":p{next(counter)}" for _ in range(arity))
+    return f"{column_name} {operator} ({placeholders})"
+
 
 class QueryParser(ABC):
     def __init__(self) -> None:
         super().__init__()
 
-    def value_is_number_or_bool(self, value) -> bool:
-        return type(value) == int or type(value) == float or type(value) == bool
-
     def audition_insert_column(self, columns: list[dict], data: dict) -> dict:
         columns_map = {}
         for column in columns:
@@ -20,83 +113,113 @@ class QueryParser(ABC):
 
         return data
 
-    def audition_filter_columns(self, columns: list[str], query: list[Union[Query, Condition]]) -> list[str]:
-        for query_item in query:
-            for condition_or_query_and in query_item.and_:
-                if isinstance(condition_or_query_and, Condition):
-                    if condition_or_query_and.column_name not in columns:
-                        condition_or_query_and.will_be_processed = False
+    def audition_select_columns(self, columns: list[dict], fields: list[str], required: list[str]) -> str:
+        # fields that are not columns of the table are ignored, nothing left means every column
+        column_names = {column[COLUMN_NAME] for column in columns}
+
+        selected = [field for field in fields if field in column_names]
+        if not selected:
+            return '*'
+
+        selected.extend(column for column in required if column in column_names)
+
+        return ', '.join(dict.fromkeys(selected))
+
+    @profiled(KIND_PARSE)
+    def audition_filter_columns(self, columns: list[dict], query: list[Union[Query, Condition]]) -> Tuple[list[str], dict]:
+        # conditions on columns that do not exist in the table are ignored
+        column_types = {column[COLUMN_NAME]: column['data_type'] for column in columns}
 
-            for condition_or_query_or in query_item.or_:
-                if isinstance(condition_or_query_or, Condition):
-                    if condition_or_query_or.column_name not in columns:
-                        condition_or_query_or.will_be_processed = False
+        # the top level list is AND-ed together
+        values = []
+        and_shapes = self.build_group(query, column_types, values)
+        if not and_shapes:
+            return [], {}
 
-        where_clauses = [self.build_query(query) for query in query]
+        shape = (SHAPE_QUERY, and_shapes, ())
 
-        # remove where_clauses member if empty
-        where_clauses = [clause for clause in where_clauses if clause]
+        where_clause = compile_shape(shape)
+        params = {f'p{index}': value for index, value in enumerate(values)}
 
-        return where_clauses
+        return [where_clause], params
+
+    def used_conditions(self, query) -> list[Tuple[str, str]]:
+        # (column, operator) of every condition audition_filter_columns kept, for the filter usage statistics
+        if isinstance(query, Query):
+            return self.used_conditions(query.and_) + self.used_conditions(query.or_)
+
+        conditions = []
+        for condition_or_query in query:
+            if isinstance(condition_or_query, Query):
+                conditions.extend(self.used_conditions(condition_or_query))
+                continue
+
+            operator = OPERATORS.get(condition_or_query.operator.strip().lower())
+            if condition_or_query.will_be_processed and operator is not None:
+                conditions.append((condition_or_query.column_name, operator))
+
+        return conditions
+
+    def build_condition(self, condition: Condition, column_types: dict, values: list) -> Union[tuple, None]:
+        if condition.column_name not in column_types:
+            condition.will_be_processed = False
 
-    def build_condition(self, condition: Condition) -> str:
         if not condition.will_be_processed:
-            return EMPTY_STRING
+            return None
 
-        if condition.operator.lower() == 'IN'.lower():
-            if self.value_is_number_or_bool(condition.value):
-                return f"{condition.column_name} {condition.operator} ({', '.join([str(v) for v in condition.value])})"
-            else:
-                in_string = ', '.join([f"'{v}'" for v in condition.value])
-                return f"{condition.column_name} {condition.operator} ({in_string})"
-        else:
-            if self.value_is_number_or_bool(condition.value):
-                return f"{condition.column_name} {condition.operator} {condition.value}"
-            else:
-                return f"{condition.column_name} {condition.operator} '{condition.value}'"
+        operator = OPERATORS.get(condition.operator.strip().lower())
+        if operator is None:
+            return None
 
-    def build_query(self, query: Query) -> str:
-        parts = []
+        data_type = column_types[condition.column_name]
+        if operator in TEXT_OPERATORS:
+            data_type = 'text'
 
-        for condition_or_query in query.and_:
-            if isinstance(condition_or_query, Condition):
-                query_str = self.build_condition(condition_or_query)
+        if operator in LIST_OPERATORS:
+            items = condition.value if isinstance(condition.value, list) else [condition.value]
+            if not items:
+                return SHAPE_CONDITION, condition.column_name, operator, 0
 
-                if len(query_str) > 1:
-                    parts.append(self.build_condition(condition_or_query))
-            else:
-                query_str = self.build_query(condition_or_query)
+            if len(items) > MAX_IN_LIST_PLACEHOLDERS:
+                values.append([coerce_value(data_type, item) for item in items])
+                return SHAPE_CONDITION, condition.column_name, operator, ARRAY_ARITY
 
-                if len(query_str) > 1:
-                    parts.append(query_str)
+            arity = arity_bucket(len(items))
+            items = items + [items[-1]] * (arity - len(items))
+            values.extend(coerce_value(data_type, item) for item in items)
 
-        and_query = ' AND '.join(parts)
+            return SHAPE_CONDITION, condition.column_name, operator, arity
 
-        parts = []
+        # a list only makes sense for IN / NOT IN
+        if isinstance(condition.value, list):
+            return None
 
-        for condition_or_query in query.or_:
-            if isinstance(condition_or_query, Condition):
-                query_str = self.build_condition(condition_or_query)
+        values.append(coerce_value(data_type, condition.value))
+
+        return SHAPE_CONDITION, condition.column_name, operator, None
+
+    def build_group(self, items, column_types: dict, values: list) -> tuple:
+        if isinstance(items, Query):
+            items = [items]
 
-                if len(query_str) > 1:
-                    parts.append(query_str)
+        shapes = []
+        for condition_or_query in items:
+            if isinstance(condition_or_query, Condition):
+                shape = self.build_condition(condition_or_query, column_types, values)
             else:
-                query_str = self.build_query(condition_or_query)
+                shape = self.build_query(condition_or_query, column_types, values)
 
-                if len(query_str) > 1:
-                    parts.append(query_str)
+            if shape is not None:
+                shapes.append(shape)
 
-        or_query = ' OR '.join(parts)
+        return tuple(shapes)
 
-        if and_query and or_query and len(and_query) > 1 and len(or_query) > 1:
-            return f"({and_query}) AND ({or_query})"
-        elif and_query:
-            if len(and_query) > 1:
-                return f"({and_query})"
-            else:
-                return EMPTY_STRING
-        else:
-            if len(or_query) > 1:
-                return f"({or_query})"
-            else:
-                return EMPTY_STRING
+    def build_query(self, query: Query, column_types: dict, values: list) -> Union[tuple, None]:
+        # the shape only holds columns, operators, nesting and IN-list buckets, never values
+        and_shapes = self.build_group(query.and_, column_types, values)
+        or_shapes = self.build_group(query.or_, column_types, values)
+
+        if not and_shapes and not or_shapes:
+            return None
+
+        return SHAPE_QUERY, and_shapes, or_shapes
@@ -1,11 +1,26 @@
+import asyncio
+import logging
+import time
+import orjson
+from typing import AsyncIterator, Tuple, Union
+from sqlalchemy.ext.asyncio import AsyncSession
+from config.config import GUNICORN_CONFIG
+from pkg.conn.database import async_session
 from core.repository.catalog_repository.implement import CatalogRepository
-from core.entity.catalog import GetTableColumnsRequest, GetTableAttributesRequest, GetTableDataRequest, CreateTableRecordRequest, COLUMN_NAME, FOREIGN_TABLE_SCHEMA, FOREIGN_TABLE_NAME, FOREIGN_COLUMN_NAME
+from core.repository.catalog_repository.query_parser import table_fields, TEXT_OPERATORS, NEGATED_OPERATORS, TRIGRAM_OPERATOR_CLASSES
+from pkg.monitor.filter_usage import filter_usage
+from pkg.helper.type_coercion import key_value
+from pkg.monitor.profiler import profiled, KIND_EXPAND
+from pkg.guard.query_guard import query_guard, GUARD_QUEUE
+from core.entity.catalog import GetTableColumnsRequest, GetTableAttributesRequest, GetTableDataRequest, CreateTableRecordRequest, BulkCreateTableRecordRequest, UpsertTableRecordsRequest, BulkUpdateTableRecordsRequest, AggregateTableDataRequest, COLUMN_NAME, FOREIGN_TABLE_SCHEMA, FOREIGN_TABLE_NAME, FOREIGN_COLUMN_NAME, PAGINATION_KEYSET, EXPAND_LATERAL, COUNT_EXACT
+
+logger = logging.getLogger(__name__)
 
 
 class CatalogUseCase:
-    def __init__(self) -> None:
+    def __init__(self, session: AsyncSession) -> None:
         super().__init__()
-        self.CatalogRepo = CatalogRepository()
+        self.CatalogRepo = CatalogRepository(session)
 
     async def get_primary_key(self, req: GetTableAttributesRequest) -> list[str]:
         return await self.CatalogRepo.get_primary_key(req)
@@ -14,98 +29,344 @@ class CatalogUseCase:
         return await self.CatalogRepo.get_table_columns(req)
 
     async def get_table_data_by_ids(self, req: GetTableDataRequest):
-        records = await self.CatalogRepo.get_table_data(req)
+        records = await self.CatalogRepo.get_table_data_by_ids(req)
 
-        req_foreign = GetTableColumnsRequest(
-            schema_name=req.schema_name,
-            table_name=req.table_name
-        )
-        foreign_keys = await self.CatalogRepo.get_table_foreign_keys(req_foreign)
-
-        for foreign_key in foreign_keys:
-            foreign_ids = []
-            for record in records:
-                # check if the value is text or others
-                if isinstance(record[foreign_key[COLUMN_NAME]], str):
-                    k = record[foreign_key[COLUMN_NAME]].strip()
-                else:
-                    k = record[foreign_key[COLUMN_NAME]]
-
-                foreign_ids.append(k)
-
-            # combine schema name and table name
-            table_name = f"{foreign_key[FOREIGN_TABLE_SCHEMA]}.{foreign_key[FOREIGN_TABLE_NAME]}"
-            req_foreign = GetTableDataRequest(
-                table_name=table_name,
-                ids=foreign_ids,
-                custom_column=foreign_key[FOREIGN_COLUMN_NAME]
-            )
-            # call get_table_data_by_ids recursively, but prevent infinite loop, but allow the same table_name
-            foreign_records = await self.CatalogRepo.get_table_data_by_ids(req_foreign)
+        # check if records return error
+        if 'error' in records:
+            return records
 
-            # create dict foreign_records with id as key
-            foreign_records_dict = {}
-            for foreign_record in foreign_records:
-                foreign_records_dict[foreign_record[foreign_key[FOREIGN_COLUMN_NAME]]] = foreign_record
+        return await self.expand_foreign_keys(req, records)
 
-            # assign foreign_records to records
-            for record in records:
-                record[foreign_key[FOREIGN_TABLE_NAME]] = foreign_records_dict.get(record[foreign_key[COLUMN_NAME]], {})
+    async def get_table_data(self, req: GetTableDataRequest):
+        started_at = time.perf_counter()
+        self.CatalogRepo.filter_conditions = []
+        data = await self.guard_table_data(req)
 
-        return records
+        # only conditions that were checked against the catalog are counted, a request that failed earlier has none
+        if self.CatalogRepo.filter_conditions:
+            filter_usage.record(req.schema_name, req.table_name, self.CatalogRepo.filter_conditions, time.perf_counter() - started_at)
+
+        return data
+
+    async def guard_table_data(self, req: GetTableDataRequest):
+        if not GUNICORN_CONFIG.QUERY_GUARD_ENABLED:
+            return await self.read_table_data(req)
+
+        # the planner estimate of the page statement decides before anything runs
+        estimate = await self.CatalogRepo.estimate_table_data(req)
+
+        # check if estimate return error
+        if isinstance(estimate, dict):
+            return estimate
+
+        # an exact count reads every match of the same filter, it is admitted together with the page
+        if req.count == COUNT_EXACT:
+            count_estimate = await self.CatalogRepo.estimate_count_table_data(req)
+
+            # check if count_estimate return error
+            if isinstance(count_estimate, dict):
+                return count_estimate
+
+            estimate = query_guard.combine(estimate, count_estimate)
+
+        return await self.admit(req.schema_name, req.table_name, estimate, lambda: self.read_table_data(req))
+
+    async def admit(self, schema_name: str, table_name: str, estimate: tuple, read):
+        violation = query_guard.violation(schema_name, table_name, estimate)
+        if violation is None:
+            return await read()
+
+        if GUNICORN_CONFIG.QUERY_GUARD_ACTION != GUARD_QUEUE:
+            return {'error': f'Query rejected: {violation}'}
+
+        # expensive statements wait for a slot instead of running side by side
+        try:
+            await asyncio.wait_for(query_guard.semaphore.acquire(), GUNICORN_CONFIG.QUERY_GUARD_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {'error': f'Query rejected after waiting {GUNICORN_CONFIG.QUERY_GUARD_QUEUE_TIMEOUT:.0f}s in the queue: {violation}'}
+
+        try:
+            return await read()
+        finally:
+            query_guard.semaphore.release()
+
+    async def read_table_data(self, req: GetTableDataRequest):
+        # the count compiles the same filter as the page, an unknown mode fails before the page is read
+        count = None
+        if req.count:
+            count = await self.CatalogRepo.count_table_data(req)
+
+            # check if count return error
+            if isinstance(count, dict):
+                return count
+
+        if req.pagination == PAGINATION_KEYSET:
+            page = await self.CatalogRepo.get_table_data_keyset(req)
+
+            # check if page return error
+            if 'error' in page:
+                return page
+
+            page['data'] = await self.expand_foreign_keys(req, page['data'])
+            if req.count:
+                page['count'] = count
+
+            return page
 
-    async def get_table_data(self, req: GetTableDataRequest):
         records = await self.CatalogRepo.get_table_data(req)
 
+        # serialized by postgres, the json bytes go to the response as they are
+        if isinstance(records, bytes):
+            if req.count:
+                return b'{"data":' + records + b',"count":' + orjson.dumps(count) + b'}'
+
+            return records
+
         # check if records return error
         if 'error' in records:
             return records
 
-        req_foreign = GetTableColumnsRequest(
-            schema_name=req.schema_name,
-            table_name=req.table_name
-        )
-        foreign_keys = await self.CatalogRepo.get_table_foreign_keys(req_foreign)
-
-        for foreign_key in foreign_keys:
-            foreign_ids = []
-            for record in records:
-                # check if the value is text or others
-                if isinstance(record[foreign_key[COLUMN_NAME]], str):
-                    k = record[foreign_key[COLUMN_NAME]].strip()
-                else:
-                    k = record[foreign_key[COLUMN_NAME]]
-
-                # detect if k exist and not None
-                if k:
-                    foreign_ids.append(k)
-
-            # combine schema name and table name
-            print("foreign_ids", foreign_ids)
-            table_name = f"{foreign_key[FOREIGN_TABLE_SCHEMA]}.{foreign_key[FOREIGN_TABLE_NAME]}"
-            req_foreign = GetTableDataRequest(
-                table_name=table_name,
-                ids=foreign_ids,
-                custom_column=foreign_key[FOREIGN_COLUMN_NAME]
-            )
-            foreign_records = await self.CatalogRepo.get_table_data_by_ids(req_foreign)
+        records = await self.expand_foreign_keys(req, records)
+        if req.count:
+            return {'data': records, 'count': count}
+
+        return records
 
-            # create dict foreign_records with id as key
-            foreign_records_dict = {}
-            for foreign_record in foreign_records:
-                if isinstance(foreign_record, dict):
-                    key = foreign_record[foreign_key[FOREIGN_COLUMN_NAME]]
-                    foreign_records_dict[key] = foreign_record
-                    foreign_record_attr = foreign_key[FOREIGN_COLUMN_NAME]
-                    key = foreign_record[foreign_record_attr]
-                    foreign_records_dict[key] = foreign_record
+    async def get_search_mode(self, schema_name: str, table_name: str) -> str:
+        return await self.CatalogRepo.get_search_mode(schema_name, table_name)
+
+    async def aggregate_table_data(self, req: AggregateTableDataRequest):
+        started_at = time.perf_counter()
+        self.CatalogRepo.filter_conditions = []
+        data = await self.guard_aggregate_table_data(req)
+
+        if self.CatalogRepo.filter_conditions:
+            filter_usage.record(req.schema_name, req.table_name, self.CatalogRepo.filter_conditions, time.perf_counter() - started_at)
+
+        return data
+
+    async def guard_aggregate_table_data(self, req: AggregateTableDataRequest):
+        if not GUNICORN_CONFIG.QUERY_GUARD_ENABLED:
+            return await self.CatalogRepo.aggregate_table_data(req)
+
+        # the same filter tree as POST /data/table, under the same limits
+        estimate = await self.CatalogRepo.estimate_aggregate_table_data(req)
+
+        # check if estimate return error
+        if isinstance(estimate, dict):
+            return estimate
+
+        return await self.admit(req.schema_name, req.table_name, estimate, lambda: self.CatalogRepo.aggregate_table_data(req))
+
+    async def explain_table_data(self, req: GetTableDataRequest, analyze: bool):
+        # analyze runs the statement for real, it gets the limits POST /data/table would apply to it
+        if not analyze or not GUNICORN_CONFIG.QUERY_GUARD_ENABLED:
+            return await self.CatalogRepo.explain_table_data(req, analyze)
+
+        estimate = await self.CatalogRepo.estimate_table_data(req)
+
+        # check if estimate return error
+        if isinstance(estimate, dict):
+            return estimate
+
+        return await self.admit(req.schema_name, req.table_name, estimate, lambda: self.CatalogRepo.explain_table_data(req, analyze))
+
+    async def advise_indexes(self) -> dict:
+        usage = filter_usage.snapshot()
+
+        # operators and time are summed per column, the time spent filtering on a column is what an index could save
+        columns = {}
+        for entry in usage:
+            if entry['operator'] in NEGATED_OPERATORS:
+                continue
+
+            column = columns.setdefault((entry['schema_name'], entry['table_name'], entry['column_name']), {'operators': set(), 'calls': 0, 'total_ms': 0.0})
+            column['operators'].add(entry['operator'])
+            column['calls'] += entry['calls']
+            column['total_ms'] += entry['total_ms']
+
+        leading_columns_per_table = {}
+        suggestions = []
+        for (schema_name, table_name, column_name), column in sorted(columns.items(), key=lambda item: item[1]['total_ms'], reverse=True):
+            if (schema_name, table_name) not in leading_columns_per_table:
+                leading_columns_per_table[(schema_name, table_name)] = await self.CatalogRepo.get_index_leading_columns(schema_name, table_name)
+            indexes = leading_columns_per_table[(schema_name, table_name)].get(column_name, [])
+
+            # comparisons need a btree led by the column, pattern matches a trigram index on it
+            statements = []
+            if column['operators'] - TEXT_OPERATORS and not any(access_method == 'btree' for access_method, _ in indexes):
+                statements.append(f'CREATE INDEX CONCURRENTLY ON {schema_name}.{table_name} ({column_name})')
+            if column['operators'] & TEXT_OPERATORS and not any(operator_class in TRIGRAM_OPERATOR_CLASSES for _, operator_class in indexes):
+                statements.append(f'CREATE INDEX CONCURRENTLY ON {schema_name}.{table_name} USING gin ({column_name} gin_trgm_ops)')
+
+            if statements:
+                suggestions.append({
+                    'schema_name': schema_name,
+                    'table_name': table_name,
+                    'column_name': column_name,
+                    'operators': sorted(column['operators']),
+                    'calls': column['calls'],
+                    'total_ms': round(column['total_ms'], 3),
+                    'statements': statements,
+                })
+
+        return {'since': filter_usage.started_at, 'suggestions': suggestions, 'usage': usage}
+
+    async def get_read_tables(self, req: GetTableDataRequest) -> set:
+        # the base table plus every table the foreign key expansion may read, cached responses are tagged with them
+        tables = {(req.schema_name, req.table_name)}
+
+        expand_depth = 1 if req.expand_mode == EXPAND_LATERAL else min(req.expand_depth, GUNICORN_CONFIG.EXPAND_MAX_DEPTH)
+
+        frontier = set(tables)
+        for _ in range(expand_depth):
+            next_frontier = set()
+            for schema_name, table_name in frontier:
+                req_foreign = GetTableColumnsRequest(
+                    schema_name=schema_name,
+                    table_name=table_name
+                )
+                for foreign_key in await self.CatalogRepo.get_table_foreign_keys(req_foreign):
+                    table = (foreign_key[FOREIGN_TABLE_SCHEMA], foreign_key[FOREIGN_TABLE_NAME])
+                    if table not in tables:
+                        tables.add(table)
+                        next_frontier.add(table)
+
+            frontier = next_frontier
+
+        return tables
+
+    async def stream_table_data(self, req: GetTableDataRequest, batch_size: int) -> AsyncIterator[Union[list[dict], dict]]:
+        async for records in self.CatalogRepo.stream_table_data(req, batch_size):
+            # foreign keys are resolved batch by batch so memory stays bounded, an error dict is passed on as is
+            if records and isinstance(records, list):
+                records = await self.expand_foreign_keys(req, records)
+
+            yield records
+
+    @profiled(KIND_EXPAND)
+    async def expand_foreign_keys(self, req: GetTableDataRequest, records: list[dict]) -> list[dict]:
+        # the lateral mode already joined the foreign records in sql
+        if not records or req.expand_mode == EXPAND_LATERAL:
+            return records
+
+        expand_depth = min(req.expand_depth, GUNICORN_CONFIG.EXPAND_MAX_DEPTH)
+
+        # request scoped identity map, (schema, table, column, key) -> (level, plain copy, expanded record)
+        identity_map = {}
+
+        # each level is expanded breadth first: the rows of one level are grouped by table and by the
+        # foreign key path that reached them, one query per referenced (table, column) covers the whole level
+        frontier = {(req.schema_name, req.table_name, frozenset()): records}
+
+        for level in range(1, expand_depth + 1):
+            # foreign key metadata comes from the catalog cache, the session cannot run these concurrently anyway
+            groups = list(frontier.items())
+            foreign_keys_per_group = []
+            for (schema_name, table_name, _), _ in groups:
+                req_foreign = GetTableColumnsRequest(
+                    schema_name=schema_name,
+                    table_name=table_name
+                )
+                foreign_keys_per_group.append(await self.CatalogRepo.get_table_foreign_keys(req_foreign))
+
+            # read every key before stitching, a stitched object may replace a column another foreign key uses
+            stitches = []
+            wanted = {}
+            for ((schema_name, table_name, path), group_records), foreign_keys in zip(groups, foreign_keys_per_group):
+                for foreign_key in foreign_keys:
+                    # following the same (table, column) twice on one path is a cycle
+                    edge = (schema_name, table_name, foreign_key[COLUMN_NAME])
+                    if edge in path:
+                        continue
+
+                    target = (foreign_key[FOREIGN_TABLE_SCHEMA], foreign_key[FOREIGN_TABLE_NAME], foreign_key[FOREIGN_COLUMN_NAME])
+                    keys = [self.foreign_id(record.get(foreign_key[COLUMN_NAME])) for record in group_records]
+
+                    # rows already in the identity map are never fetched twice
+                    foreign_ids = wanted.setdefault(target, set())
+                    foreign_ids.update(key for key in keys if key is not None and target + (key,) not in identity_map)
+
+                    stitches.append((group_records, keys, target, path | {edge}))
+
+            if not stitches:
+                break
+
+            # all referenced tables of this level are queried concurrently
+            targets = list(wanted.keys())
+            results = await asyncio.gather(*[
+                self.get_foreign_records(target, wanted[target], table_fields(req.fields, target[1]), index > 0) for index, target in enumerate(targets)
+            ])
+            errors = {}
+            for target, (foreign_records_dict, error) in zip(targets, results):
+                if error is not None:
+                    errors[target] = error
+
+                for key, foreign_record in foreign_records_dict.items():
+                    identity_map[target + (key,)] = (level, dict(foreign_record), foreign_record)
 
             # assign foreign_records to records
-            for record in records:
-                record[foreign_key[FOREIGN_TABLE_NAME]] = foreign_records_dict.get(record[foreign_key[COLUMN_NAME]], {})
+            frontier = {}
+            expanded = set()
+            for group_records, keys, target, path in stitches:
+                foreign_schema, foreign_table, _ = target
+                for record, key in zip(group_records, keys):
+                    entry = identity_map.get(target + (key,)) if key is not None else None
+                    if entry is None:
+                        # a failed lookup must not look like a missing reference
+                        record[foreign_table] = {'error': errors[target]} if key is not None and target in errors else {}
+                        continue
+
+                    entry_level, plain_record, foreign_record = entry
+                    if entry_level < level:
+                        # fetched on a shallower level, link a plain copy so the result stays a tree
+                        record[foreign_table] = plain_record
+                        continue
+
+                    record[foreign_table] = foreign_record
+                    if id(foreign_record) not in expanded:
+                        expanded.add(id(foreign_record))
+                        frontier.setdefault((foreign_schema, foreign_table, path), []).append(foreign_record)
 
         return records
 
+    async def get_foreign_records(self, target: tuple, foreign_ids: set, fields: list[str], own_session: bool) -> Tuple[dict, Union[str, None]]:
+        # returns the records by key and the error of the lookup, if any
+        if not foreign_ids:
+            return {}, None
+
+        # combine schema name and table name
+        foreign_schema, foreign_table, foreign_column = target
+        req_foreign = GetTableDataRequest(
+            table_name=f"{foreign_schema}.{foreign_table}",
+            ids=list(foreign_ids),
+            custom_column=foreign_column,
+            fields=fields
+        )
+
+        if own_session:
+            async with async_session() as session:
+                foreign_records = await CatalogRepository(session).get_table_data_by_ids(req_foreign)
+        else:
+            foreign_records = await self.CatalogRepo.get_table_data_by_ids(req_foreign)
+
+        # an error (a timeout, an exhausted pool) fails only the references to this table, not the whole page
+        if isinstance(foreign_records, dict):
+            logger.warning("foreign key lookup on %s.%s.%s failed: %s", foreign_schema, foreign_table, foreign_column, foreign_records['error'])
+            return {}, foreign_records['error']
+
+        # create dict foreign_records with id as key
+        return {self.foreign_id(foreign_record[foreign_column]): foreign_record for foreign_record in foreign_records}, None
+
+    @staticmethod
+    def foreign_id(value):
+        # char(n) keys come back padded, an empty text key is no reference at all
+        value = key_value(value)
+        if value == '':
+            return None
+
+        return value
+
     async def get_table_data_by_id(self, req: GetTableDataRequest):
         if '.' in req.table_name and req.schema_name is None:
             schema_name, table_name = req.table_name.split('.')
@@ -113,14 +374,14 @@ class CatalogUseCase:
             schema_name = req.schema_name
             table_name = req.table_name
 
-        # get primary key first
+        # get primary key first, it comes from the catalog cache after the first lookup
         req_attr = GetTableAttributesRequest(
             schema_name=schema_name,
             table_name=table_name
         )
         primary_key = await self.get_primary_key(req_attr)
 
-        # we need to add handler if primary key is composite
+        # composite keys are looked up with {column: value} ids
         if len(primary_key) > 1:
             req.is_composite_primary_key = True
 
@@ -137,6 +398,7 @@ class CatalogUseCase:
     async def get_table_attributes(self, req: GetTableAttributesRequest):
 
         req_columns = GetTableColumnsRequest(
+            schema_name=req.schema_name,
             table_name=req.table_name,
             complete_attribute=req.complete_attribute
         )
@@ -151,6 +413,7 @@ class CatalogUseCase:
 
         if req.with_data:
             req_data = GetTableDataRequest(
+                schema_name=req.schema_name,
                 table_name=req.table_name,
                 page=req.page,
                 page_size=req.page_size,
@@ -193,6 +456,71 @@ class CatalogUseCase:
 
         return result
 
+    async def validate_records(self, schema_name: str, table_name: str, data: list[dict]):
+        # first, get the primary key
+        req_attr = GetTableAttributesRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        primary_key = await self.get_primary_key(req_attr)
+
+        primary_key_list = []
+        for key in primary_key:
+            primary_key_list.append(key['attname'])
+
+        if len(primary_key) == 0:
+            return {'error': 'Primary key is required'}
+
+        # check mandatory column, the column set is read once for the whole payload
+        req_column = GetTableColumnsRequest(
+            schema_name=schema_name,
+            table_name=table_name
+        )
+        columns = await self.get_table_columns(req_column)
+
+        mandatory_columns = [column[COLUMN_NAME] for column in columns if column['is_nullable'] == 'NO' and column[COLUMN_NAME] not in primary_key_list]
+
+        records = []
+        failed = []
+        for index, record in enumerate(data):
+            missing_columns = [mandatory_column for mandatory_column in mandatory_columns if mandatory_column not in record]
+            if missing_columns:
+                failed.append({'index': index, 'error': f'{missing_columns[0]} is mandatory'})
+                continue
+
+            records.append((index, record))
+
+        return records, failed, primary_key_list
+
+    async def create_table_records(self, req: BulkCreateTableRecordRequest):
+        validated = await self.validate_records(req.schema_name, req.table_name, req.data)
+        if isinstance(validated, dict):
+            return validated
+
+        records, failed, primary_key_list = validated
+        result = await self.CatalogRepo.create_table_records(req, records, primary_key_list)
+
+        result['failed'] = sorted(failed + result['failed'], key=lambda failure: failure['index'])
+
+        return result
+
+    async def upsert_table_records(self, req: UpsertTableRecordsRequest):
+        validated = await self.validate_records(req.schema_name, req.table_name, req.data)
+        if isinstance(validated, dict):
+            return validated
+
+        # the detected primary key, composite or not, is the conflict target
+        records, failed, primary_key_list = validated
+        result = await self.CatalogRepo.upsert_table_records(req, records, primary_key_list)
+
+        # check if result return error
+        if 'error' in result:
+            return result
+
+        result['failed'] = sorted(failed + result['failed'], key=lambda failure: failure['index'])
+
+        return result
+
     async def update_table_record(self, req: CreateTableRecordRequest):
         # first, get the primary key
         req_attr = GetTableAttributesRequest(
@@ -215,3 +543,20 @@ class CatalogUseCase:
         result = await self.CatalogRepo.update_table_record(req)
 
         return result
+
+    async def update_table_records(self, req: BulkUpdateTableRecordsRequest):
+        # first, get the primary key, composite keys are matched column by column
+        req_attr = GetTableAttributesRequest(
+            schema_name=req.schema_name,
+            table_name=req.table_name
+        )
+        primary_key = await self.get_primary_key(req_attr)
+
+        primary_key_list = []
+        for key in primary_key:
+            primary_key_list.append(key['attname'])
+
+        if len(primary_key) == 0:
+            return {'error': 'Primary key is required'}
+
+        return await self.CatalogRepo.update_table_records(req, primary_key_list)
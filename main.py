@@ -1,67 +1,219 @@
+import asyncio
 import uvicorn
-from fastapi import FastAPI
+import orjson
+from fastapi import FastAPI, Depends, Request
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from config.config import GUNICORN_CONFIG
-from pkg.conn.database import database
+from pkg.conn.database import engine, async_session, get_session, notify_listener, set_statement_timeout, DATABASE_DSN
+from pkg.cache.catalog_cache import catalog_cache, install_ddl_trigger
+from pkg.cache.response_cache import response_cache, etag_matches, install_write_triggers, publish_write
+from pkg.guard.query_guard import query_guard
+from pkg.monitor import metrics
+from pkg.monitor.slow_query import slow_query_log
+from pkg.monitor import profiler
 from core.usecase.catalog_usecase import CatalogUseCase
 
-from core.entity.catalog import GetTableColumnsRequest, GetTableAttributesRequest, GetTableDataRequest, CreateTableRecordRequest, SCHEMA_PUBLIC
+from core.entity.catalog import GetTableColumnsRequest, GetTableAttributesRequest, GetTableDataRequest, CreateTableRecordRequest, BulkCreateTableRecordRequest, UpsertTableRecordsRequest, BulkUpdateTableRecordsRequest, AggregateTableDataRequest, SCHEMA_PUBLIC, BULK_VALUES, STREAM_NDJSON, STREAM_CSV
 from pkg.helper.table_name import normalize_schema_and_table_name
+from pkg.helper.stream_format import to_ndjson, CsvWriter
+from pkg.helper.json_default import json_default
 
 
 def init_app() -> FastAPI:
-    _app = FastAPI()
+    _app = FastAPI(default_response_class=ORJSONResponse)
+    # routes declared below time their request validation when the request is profiled
+    _app.router.route_class = profiler.ProfiledRoute
+    _app.add_middleware(metrics.MetricsMiddleware)
+    _app.add_middleware(profiler.ProfileMiddleware)
     return _app
 
 
+def init_catalog_cache(_app: FastAPI):
+    def invalidate_object(object_identity: str):
+        # a DDL change also changes what the cached responses of the table look like
+        catalog_cache.invalidate_object(object_identity)
+        response_cache.invalidate_object(object_identity)
+
+        # a new index changes the plans the guard has estimated
+        query_guard.clear()
+
+    if GUNICORN_CONFIG.CATALOG_CACHE_LISTEN:
+        notify_listener.add_channel(GUNICORN_CONFIG.CATALOG_CACHE_CHANNEL, invalidate_object)
+        notify_listener.on_reconnect.append(catalog_cache.clear)
+
+    @_app.on_event("startup")
+    async def startup():
+        if GUNICORN_CONFIG.CATALOG_CACHE_INSTALL_TRIGGER:
+            await install_ddl_trigger(DATABASE_DSN)
+
+
+def init_response_cache(_app: FastAPI):
+    if GUNICORN_CONFIG.RESPONSE_CACHE_LISTEN:
+        notify_listener.add_channel(GUNICORN_CONFIG.RESPONSE_CACHE_CHANNEL, response_cache.invalidate_object)
+        notify_listener.on_reconnect.append(response_cache.clear)
+
+    @_app.on_event("startup")
+    async def startup():
+        tables = [table.strip() for table in GUNICORN_CONFIG.RESPONSE_CACHE_TRIGGER_TABLES.split(',') if table.strip()]
+        if tables:
+            await install_write_triggers(DATABASE_DSN, tables)
+
+
 def init_db(_app: FastAPI):
     @_app.on_event("startup")
     async def startup():
-        await database.connect()
+        notify_listener.start()
 
     @_app.on_event("shutdown")
     async def shutdown():
-        await database.disconnect()
+        await notify_listener.stop()
+        await engine.dispose()
 
 
 app = init_app()
+init_catalog_cache(app)
+init_response_cache(app)
 init_db(app)
 
 
+def cache_key(route: str, req: BaseModel) -> tuple:
+    # the normalized request body, two requests asking for the same thing share one entry
+    return route, orjson.dumps(req.model_dump(mode='json'), option=orjson.OPT_SORT_KEYS)
+
+
+def bind_request(route: str, schema_name: str = None, table_name: str = None) -> None:
+    # per route and per table settings of the request: statement_timeout and the metrics labels
+    set_statement_timeout(route, schema_name, table_name)
+    metrics.bind_route(route)
+    if table_name is not None:
+        metrics.bind_table(schema_name, table_name)
+
+
+def count_rows(data) -> int:
+    if isinstance(data, dict):
+        data = data.get('data')
+
+    return len(data) if isinstance(data, list) else 0
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def cancel_on_disconnect(request: Request, coroutine):
+    # the work runs as its own task so a client that went away can cancel it; asyncpg then sends a cancel
+    # request for the running statement and the session gives its connection back to the pool
+    task = asyncio.ensure_future(coroutine)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=GUNICORN_CONFIG.DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+
+        if await request.is_disconnected():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+            raise ClientDisconnected()
+
+
+async def cached_response(request: Request, key: tuple, load, headers: dict = None) -> Response:
+    # load returns the payload and the tables it was read from
+    headers = dict(headers or {})
+    cached = response_cache.get(key)
+    if cached is None:
+        version = response_cache.version
+        try:
+            data, tables = await cancel_on_disconnect(request, load())
+        except ClientDisconnected:
+            # nobody is listening anymore, 499 only shows up in the access log
+            return Response(status_code=499)
+
+        metrics.add_rows(count_rows(data))
+
+        # bytes were already serialized by postgres
+        with profiler.span(profiler.KIND_SERIALIZE, 'orjson'):
+            body = data if isinstance(data, bytes) else orjson.dumps(data, default=json_default)
+
+        # errors are never cached
+        if isinstance(data, dict) and 'error' in data:
+            return Response(body, media_type='application/json', headers=headers)
+
+        etag = response_cache.set(key, body, tables, version)
+    else:
+        etag, body = cached
+
+    headers['ETag'] = etag
+    if etag_matches(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(body, media_type='application/json', headers=headers)
+
+
+async def search_headers(session: AsyncSession, schema_name: str, table_name: str, keyword: str) -> dict:
+    # tells the client whether its keyword search is index backed or scans the whole table
+    if not keyword:
+        return {}
+
+    return {'X-Search-Index': await CatalogUseCase(session).get_search_mode(schema_name, table_name)}
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    # pool state is read when scraped
+    metrics.pool_connections.set(engine.pool.checkedout(), ('checked_out',))
+    metrics.pool_connections.set(engine.pool.checkedin(), ('idle',))
+    metrics.pool_connections.set(max(engine.pool.overflow(), 0), ('overflow',))
+
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @app.get("/primary-key/{table_name}")
-async def get_primary_key(table_name: str):
+async def get_primary_key(table_name: str, request: Request, session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(None, table_name)
+    bind_request("GET /primary-key/{table_name}", schema_name, table_name)
 
     req = GetTableAttributesRequest(
         schema_name=schema_name,
         table_name=table_name
     )
-    primary_key = await CatalogUseCase().get_primary_key(req)
 
-    return primary_key
+    async def load():
+        return await CatalogUseCase(session).get_primary_key(req), {(schema_name, table_name)}
+
+    return await cached_response(request, cache_key('primary-key', req), load)
 
 
 @app.get("/columns/{table_name}")
-async def get_table_columns(table_name: str, complete_attribute: bool = False):
+async def get_table_columns(table_name: str, request: Request, complete_attribute: bool = False, session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(None, table_name)
+    bind_request("GET /columns/{table_name}", schema_name, table_name)
 
     req = GetTableColumnsRequest(
         schema_name=schema_name,
         table_name=table_name,
         complete_attribute=complete_attribute
     )
-    columns = await CatalogUseCase().get_table_columns(req)
 
-    return columns
+    async def load():
+        return await CatalogUseCase(session).get_table_columns(req), {(schema_name, table_name)}
+
+    return await cached_response(request, cache_key('columns', req), load)
 
 
 @app.get("/attributes/{table_name}")
-async def get_table_attributes(table_name: str, complete_attribute: bool = False, with_data: bool = False, page: int = 1, page_size: int = 10, keyword: str = ""):
+async def get_table_attributes(table_name: str, request: Request, complete_attribute: bool = False, with_data: bool = False, page: int = 1, page_size: int = 10, keyword: str = "", session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(None, table_name)
+    bind_request("GET /attributes/{table_name}", schema_name, table_name)
 
     req = GetTableAttributesRequest(
         schema_name=schema_name,
@@ -72,49 +224,216 @@ async def get_table_attributes(table_name: str, complete_attribute: bool = False
         page_size=page_size,
         keyword=keyword
     )
-    attributes = await CatalogUseCase().get_table_attributes(req)
 
-    return attributes
+    async def load():
+        return await CatalogUseCase(session).get_table_attributes(req), {(schema_name, table_name)}
+
+    return await cached_response(request, cache_key('attributes', req), load)
 
 
 @app.post("/data/table")
-async def get_table_data(req: GetTableDataRequest):
+async def get_table_data(req: GetTableDataRequest, request: Request, session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("POST /data/table", schema_name, table_name)
     req.table_name = table_name
     req.schema_name = schema_name
 
-    data = await CatalogUseCase().get_table_data(req)
-    return data
+    # the key is taken before the query parser marks the conditions it skips
+    key = cache_key('data', req)
+    headers = await search_headers(session, schema_name, table_name, req.keyword)
+
+    async def load():
+        catalog_usecase = CatalogUseCase(session)
+        return await catalog_usecase.get_table_data(req), await catalog_usecase.get_read_tables(req)
+
+    return await cached_response(request, key, load, headers)
+
+
+@app.post("/data/table/aggregate")
+async def aggregate_table_data(req: AggregateTableDataRequest, request: Request, session: AsyncSession = Depends(get_session)):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("POST /data/table/aggregate", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    key = cache_key('aggregate', req)
+    headers = await search_headers(session, schema_name, table_name, req.keyword)
+
+    async def load():
+        return await CatalogUseCase(session).aggregate_table_data(req), {(schema_name, table_name)}
+
+    return await cached_response(request, key, load, headers)
+
+
+@app.post("/data/table/stream")
+async def stream_table_data(req: GetTableDataRequest, format: str = STREAM_NDJSON, batch_size: int = GUNICORN_CONFIG.STREAM_BATCH_SIZE):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("POST /data/table/stream", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    if format not in (STREAM_NDJSON, STREAM_CSV):
+        return {'error': f'Unsupported format {format}'}
+
+    if batch_size < 1:
+        return {'error': 'batch_size must be greater than zero'}
+
+    async def generate():
+        csv_writer = CsvWriter()
+
+        # the session has to outlive the route, so the stream opens its own instead of using get_session
+        async with async_session() as session:
+            async for records in CatalogUseCase(session).stream_table_data(req, batch_size):
+                # a database error midway ends the stream with an explicit error line in either format
+                if isinstance(records, dict):
+                    yield csv_writer.write_error(records['error']) if format == STREAM_CSV else to_ndjson([records])
+                    return
+
+                metrics.add_rows(len(records))
+                if format == STREAM_CSV:
+                    yield csv_writer.write(records)
+                else:
+                    yield to_ndjson(records)
+
+    media_type = 'text/csv' if format == STREAM_CSV else 'application/x-ndjson'
+    return StreamingResponse(generate(), media_type=media_type)
 
 
 @app.post("/data/table/id")
-async def get_table_data_by_id(req: GetTableDataRequest):
+async def get_table_data_by_id(req: GetTableDataRequest, request: Request, session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("POST /data/table/id", schema_name, table_name)
     req.table_name = table_name
     req.schema_name = schema_name
 
-    data = await CatalogUseCase().get_table_data_by_id(req)
+    key = cache_key('data-id', req)
+
+    async def load():
+        return await CatalogUseCase(session).get_table_data_by_id(req), {(schema_name, table_name)}
+
+    return await cached_response(request, key, load)
+
+
+@app.post("/explain")
+async def explain_table_data(req: GetTableDataRequest, request: Request, analyze: bool = False, session: AsyncSession = Depends(get_session)):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("POST /explain", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    try:
+        data = await cancel_on_disconnect(request, CatalogUseCase(session).explain_table_data(req, analyze))
+    except ClientDisconnected:
+        return Response(status_code=499)
+
     return data
 
 
+@app.get("/advisor")
+async def advise_indexes(session: AsyncSession = Depends(get_session)):
+    bind_request("GET /advisor")
+
+    data = await CatalogUseCase(session).advise_indexes()
+    return data
+
+
+@app.get("/debug/slow")
+async def get_slow_queries():
+    # newest first, a sampled entry gets its plan once the background EXPLAIN ANALYZE is done
+    return slow_query_log.snapshot()
+
+
+@app.get("/debug/profiles")
+async def get_profiles():
+    # requests sent with "X-Genapi-Profile: 1" (or "cpu"), newest first
+    return profiler.snapshot()
+
+
 @app.put("/data/table")
-async def create_table_record(req: CreateTableRecordRequest):
+async def create_table_record(req: CreateTableRecordRequest, session: AsyncSession = Depends(get_session)):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("PUT /data/table", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    data = await CatalogUseCase(session).create_table_record(req)
+
+    await publish_write(session, schema_name, table_name)
+    return data
+
+
+@app.put("/data/table/bulk")
+async def create_table_records(request: Request, table_name: str = None, schema_name: str = None, method: str = BULK_VALUES, batch_size: int = 0, return_id: bool = False, session: AsyncSession = Depends(get_session)):
+    body = await request.body()
+
+    try:
+        # an NDJSON body carries one record per line, the target table comes from the query string
+        if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+            req = BulkCreateTableRecordRequest(
+                schema_name=schema_name or SCHEMA_PUBLIC,
+                table_name=table_name,
+                data=[orjson.loads(line) for line in body.splitlines() if line.strip()],
+                method=method,
+                batch_size=batch_size,
+                return_id=return_id
+            )
+        else:
+            req = BulkCreateTableRecordRequest.model_validate_json(body)
+    except (ValidationError, orjson.JSONDecodeError) as e:
+        return {'error': str(e)}
+
     schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("PUT /data/table/bulk", schema_name, table_name)
     req.table_name = table_name
     req.schema_name = schema_name
 
-    data = await CatalogUseCase().create_table_record(req)
+    data = await CatalogUseCase(session).create_table_records(req)
+
+    # even a failed bulk write may have committed some batches
+    await publish_write(session, schema_name, table_name)
+    return data
+
+
+@app.put("/data/table/upsert")
+async def upsert_table_records(req: UpsertTableRecordsRequest, session: AsyncSession = Depends(get_session)):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("PUT /data/table/upsert", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    data = await CatalogUseCase(session).upsert_table_records(req)
+
+    # even a failed bulk write may have committed some batches
+    await publish_write(session, schema_name, table_name)
     return data
 
 
 @app.patch("/data/table")
-async def update_table_record(req: CreateTableRecordRequest):
+async def update_table_record(req: CreateTableRecordRequest, session: AsyncSession = Depends(get_session)):
     schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("PATCH /data/table", schema_name, table_name)
     req.table_name = table_name
     req.schema_name = schema_name
 
-    data = await CatalogUseCase().update_table_record(req)
+    data = await CatalogUseCase(session).update_table_record(req)
+
+    await publish_write(session, schema_name, table_name)
     return data
 
+
+@app.patch("/data/table/bulk")
+async def update_table_records(req: BulkUpdateTableRecordsRequest, session: AsyncSession = Depends(get_session)):
+    schema_name, table_name = normalize_schema_and_table_name(req.schema_name, req.table_name)
+    bind_request("PATCH /data/table/bulk", schema_name, table_name)
+    req.table_name = table_name
+    req.schema_name = schema_name
+
+    data = await CatalogUseCase(session).update_table_records(req)
+
+    # even a failed bulk write may have committed some batches
+    await publish_write(session, schema_name, table_name)
+    return data
+
+
 if __name__ == '__main__':
     uvicorn.run("main:core", host=GUNICORN_CONFIG.HOST, port=GUNICORN_CONFIG.PORT, reload=True)
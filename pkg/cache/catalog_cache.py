@@ -0,0 +1,144 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+import asyncpg
+from config.config import GUNICORN_CONFIG
+from pkg.monitor.metrics import catalog_cache_requests
+
+CACHE_COLUMNS = 'columns'
+CACHE_PRIMARY_KEY = 'primary_key'
+CACHE_FOREIGN_KEYS = 'foreign_keys'
+CACHE_SEARCH_INDEXES = 'search_indexes'
+
+# event trigger that publishes the identity of every object touched by a DDL command,
+# installed once per database when GENAPI_CATALOG_CACHE_INSTALL_TRIGGER is enabled (requires superuser)
+DDL_EVENT_TRIGGER_SQL = [
+    f'''CREATE OR REPLACE FUNCTION genapi_notify_ddl() RETURNS event_trigger AS $$
+        DECLARE
+            obj record;
+            indexed_table text;
+        BEGIN
+            FOR obj IN SELECT * FROM pg_event_trigger_ddl_commands() LOOP
+                PERFORM pg_notify('{GUNICORN_CONFIG.CATALOG_CACHE_CHANNEL}', coalesce(obj.object_identity, ''));
+
+                -- an index identity names the index only, the table it belongs to is published as well
+                IF obj.object_type = 'index' THEN
+                    SELECT format('%I.%I', n.nspname, c.relname) INTO indexed_table
+                    FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indrelid
+                    JOIN pg_namespace n ON n.oid = c.relnamespace
+                    WHERE i.indexrelid = obj.objid;
+
+                    IF indexed_table IS NOT NULL THEN
+                        PERFORM pg_notify('{GUNICORN_CONFIG.CATALOG_CACHE_CHANNEL}', indexed_table);
+                    END IF;
+                END IF;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql''',
+    f'''CREATE OR REPLACE FUNCTION genapi_notify_drop() RETURNS event_trigger AS $$
+        DECLARE
+            obj record;
+        BEGIN
+            FOR obj IN SELECT * FROM pg_event_trigger_dropped_objects() LOOP
+                PERFORM pg_notify('{GUNICORN_CONFIG.CATALOG_CACHE_CHANNEL}', coalesce(obj.object_identity, ''));
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql''',
+    'DROP EVENT TRIGGER IF EXISTS genapi_ddl_command_end',
+    'CREATE EVENT TRIGGER genapi_ddl_command_end ON ddl_command_end EXECUTE FUNCTION genapi_notify_ddl()',
+    'DROP EVENT TRIGGER IF EXISTS genapi_sql_drop',
+    'CREATE EVENT TRIGGER genapi_sql_drop ON sql_drop EXECUTE FUNCTION genapi_notify_drop()',
+]
+
+
+class CatalogCache:
+    def __init__(self, ttl: int, max_tables: int) -> None:
+        super().__init__()
+
+        self.ttl = ttl
+        self.max_tables = max_tables
+        # (schema_name, table_name) -> {kind: (expires_at, value)}, least recently used first
+        self.entries: OrderedDict[Tuple[str, str], Dict[str, Tuple[float, Any]]] = OrderedDict()
+
+    def get(self, schema_name: str, table_name: str, kind: str):
+        value = self.lookup(schema_name, table_name, kind)
+        catalog_cache_requests.inc((kind, 'miss' if value is None else 'hit'))
+
+        return value
+
+    def lookup(self, schema_name: str, table_name: str, kind: str):
+        if self.ttl <= 0:
+            return None
+
+        key = (schema_name, table_name)
+        entry = self.entries.get(key)
+        if entry is None or kind not in entry:
+            return None
+
+        expires_at, value = entry[kind]
+        if expires_at < time.monotonic():
+            del entry[kind]
+            if not entry:
+                del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+
+        return value
+
+    def has_table(self, schema_name: str, table_name: str) -> bool:
+        return (schema_name, table_name) in self.entries
+
+    def set(self, schema_name: str, table_name: str, kind: str, value) -> None:
+        # callers only cache tables known to exist, table names come from the client
+        if self.ttl <= 0 or self.max_tables <= 0:
+            return
+
+        key = (schema_name, table_name)
+        entry = self.entries.setdefault(key, {})
+        entry[kind] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_tables:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, schema_name: str, table_name: str) -> None:
+        self.entries.pop((schema_name, table_name), None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def invalidate_object(self, object_identity: str) -> None:
+        # anything we cannot map to a table clears the whole cache
+        table = object_table(object_identity)
+        if table is not None:
+            self.invalidate(*table)
+        else:
+            self.clear()
+
+
+def object_table(object_identity: str):
+    # object_identity comes from the event trigger, e.g. "public.customer", "public.customer.name"
+    # or "customer_pkey on public.customer"; index or sequence names simply never match a cached table
+    if ' on ' in object_identity:
+        object_identity = object_identity.split(' on ')[-1]
+
+    parts = [part.strip('"') for part in object_identity.split('.')]
+    if len(parts) in (2, 3):
+        return parts[0], parts[1]
+
+    return None
+
+
+async def install_ddl_trigger(dsn: str) -> None:
+    connection = await asyncpg.connect(dsn)
+    try:
+        async with connection.transaction():
+            for statement in DDL_EVENT_TRIGGER_SQL:
+                await connection.execute(statement)
+    finally:
+        await connection.close()
+
+
+catalog_cache = CatalogCache(GUNICORN_CONFIG.CATALOG_CACHE_TTL, GUNICORN_CONFIG.CATALOG_CACHE_MAX_TABLES)
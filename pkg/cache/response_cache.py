@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Set, Tuple
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from config.config import GUNICORN_CONFIG
+from pkg.cache.catalog_cache import object_table
+from pkg.monitor.metrics import response_cache_requests
+
+logger = logging.getLogger(__name__)
+
+# statement level trigger that publishes "schema.table" after every write, so writes that do not go
+# through genapi (or go through another worker) invalidate the cached responses as well
+WRITE_TRIGGER_FUNCTION_SQL = f'''CREATE OR REPLACE FUNCTION genapi_notify_write() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{GUNICORN_CONFIG.RESPONSE_CACHE_CHANNEL}', TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql'''
+
+
+def write_trigger_sql(table: str) -> list[str]:
+    return [
+        f'DROP TRIGGER IF EXISTS genapi_notify_write ON {table}',
+        f'''CREATE TRIGGER genapi_notify_write
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION genapi_notify_write()''',
+    ]
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int, max_bytes: int, ttl: int) -> None:
+        super().__init__()
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # writes nobody told us about (no trigger installed, a lost notification) are seen after ttl at the latest
+        self.ttl = ttl
+        # key -> (etag, body, tables, expires_at), ordered from least to most recently used
+        self.entries: OrderedDict[Tuple, Tuple[str, bytes, frozenset, float]] = OrderedDict()
+        # (schema_name, table_name) -> keys of the responses that read the table
+        self.tables: Dict[Tuple[str, str], Set[Tuple]] = {}
+        self.size = 0
+        # bumped on every invalidation, a response computed across a write is not stored
+        self.version = 0
+
+    def get(self, key: Tuple):
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] < time.monotonic():
+            self.evict(key)
+            entry = None
+
+        if entry is None:
+            response_cache_requests.inc(('miss',))
+            return None
+
+        response_cache_requests.inc(('hit',))
+
+        self.entries.move_to_end(key)
+        etag, body, _, _ = entry
+
+        return etag, body
+
+    def set(self, key: Tuple, body: bytes, tables: set, version: int) -> str:
+        etag = self.etag(body)
+        if self.max_entries <= 0 or self.ttl <= 0 or len(body) > self.max_bytes or version != self.version:
+            return etag
+
+        self.evict(key)
+        self.entries[key] = (etag, body, frozenset(tables), time.monotonic() + self.ttl)
+        self.size += len(body)
+        for table in tables:
+            self.tables.setdefault(table, set()).add(key)
+
+        # least recently used entries go first, until both the count and the byte budget fit
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+        return etag
+
+    def evict(self, key: Tuple) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        _, body, tables, _ = entry
+        self.size -= len(body)
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def invalidate(self, schema_name: str, table_name: str) -> None:
+        self.version += 1
+        for key in list(self.tables.get((schema_name, table_name), ())):
+            self.evict(key)
+
+    def invalidate_object(self, object_identity: str) -> None:
+        table = object_table(object_identity)
+        if table is not None:
+            self.invalidate(*table)
+        else:
+            self.clear()
+
+    def clear(self) -> None:
+        self.version += 1
+        self.entries.clear()
+        self.tables.clear()
+        self.size = 0
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match may list several tags, weak tags compare equal for GET and POST reads alike
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag:
+            return True
+
+    return False
+
+
+async def install_write_triggers(dsn: str, tables: list[str]) -> None:
+    connection = await asyncpg.connect(dsn)
+    try:
+        async with connection.transaction():
+            await connection.execute(WRITE_TRIGGER_FUNCTION_SQL)
+            for table in tables:
+                for statement in write_trigger_sql(table):
+                    await connection.execute(statement)
+    finally:
+        await connection.close()
+
+
+async def publish_write(session: AsyncSession, schema_name: str, table_name: str) -> None:
+    # the local entries go right away, the other workers drop theirs when the notification arrives
+    response_cache.invalidate(schema_name, table_name)
+    if response_cache.max_entries <= 0:
+        return
+
+    try:
+        await session.execute(text("SELECT pg_notify(:channel, :payload)"), {
+            'channel': GUNICORN_CONFIG.RESPONSE_CACHE_CHANNEL,
+            'payload': f'{schema_name}.{table_name}',
+        })
+        await session.commit()
+    except SQLAlchemyError as e:
+        # the ttl still bounds how long the other workers serve the old responses
+        await session.rollback()
+        logger.warning("could not publish the write on %s.%s: %s", schema_name, table_name, e)
+
+
+response_cache = ResponseCache(GUNICORN_CONFIG.RESPONSE_CACHE_MAX_ENTRIES, GUNICORN_CONFIG.RESPONSE_CACHE_MAX_BYTES, GUNICORN_CONFIG.RESPONSE_CACHE_TTL)
@@ -1,9 +1,146 @@
-from databases import Database
-from sqlalchemy import create_engine, MetaData
+import time
+import orjson
+from contextvars import ContextVar
+from typing import AsyncIterator
+from sqlalchemy import MetaData, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from config.config import GUNICORN_CONFIG
+from pkg.conn.notify import NotifyListener
+from pkg.monitor.metrics import pool_wait, add_db_time, request_stats
+from pkg.monitor.slow_query import slow_query_log
+from pkg.monitor.profiler import start_leaf, KIND_SQL
 
-DATABASE_URL = f"{GUNICORN_CONFIG.DB_DIALECT}://{GUNICORN_CONFIG.DB_USERNAME}:{GUNICORN_CONFIG.DB_PASSWORD}@{GUNICORN_CONFIG.DB_HOST}:{GUNICORN_CONFIG.DB_PORT}/{GUNICORN_CONFIG.DB_NAME}"
+# every distinct statement text is prepared once per pooled connection and kept in asyncpg's statement cache
+DATABASE_URL = f"{GUNICORN_CONFIG.DB_DIALECT}+{GUNICORN_CONFIG.DB_DRIVER}://{GUNICORN_CONFIG.DB_USERNAME}:{GUNICORN_CONFIG.DB_PASSWORD}@{GUNICORN_CONFIG.DB_HOST}:{GUNICORN_CONFIG.DB_PORT}/{GUNICORN_CONFIG.DB_NAME}?prepared_statement_cache_size={GUNICORN_CONFIG.DB_STATEMENT_CACHE_SIZE}"
+
+# plain libpq style dsn for connections made straight through asyncpg
+DATABASE_DSN = f"postgresql://{GUNICORN_CONFIG.DB_USERNAME}:{GUNICORN_CONFIG.DB_PASSWORD}@{GUNICORN_CONFIG.DB_HOST}:{GUNICORN_CONFIG.DB_PORT}/{GUNICORN_CONFIG.DB_NAME}"
+
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    # how long a checkout waited for a free (or a new overflow) connection
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.observe((), time.perf_counter() - started_at)
+
+
+# the pool keeps DB_POOL_MIN_SIZE connections open and bursts up to DB_POOL_MAX_SIZE
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=GUNICORN_CONFIG.DB_ECHO,
+    poolclass=TimedQueuePool,
+    pool_size=GUNICORN_CONFIG.DB_POOL_MIN_SIZE,
+    max_overflow=max(GUNICORN_CONFIG.DB_POOL_MAX_SIZE - GUNICORN_CONFIG.DB_POOL_MIN_SIZE, 0),
+    pool_timeout=GUNICORN_CONFIG.DB_POOL_TIMEOUT,
+    pool_pre_ping=True,
+    # the default statement_timeout is a connection setting, per request overrides are SET LOCAL below
+    connect_args={'server_settings': {'statement_timeout': str(int(GUNICORN_CONFIG.STATEMENT_TIMEOUT))}},
+)
+async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+# the statement_timeout of the current request, tasks it spawns copy the value
+statement_timeout: ContextVar[int] = ContextVar('statement_timeout', default=GUNICORN_CONFIG.STATEMENT_TIMEOUT)
+
+
+def set_statement_timeout(route: str, schema_name: str = None, table_name: str = None) -> None:
+    timeout = GUNICORN_CONFIG.STATEMENT_TIMEOUT_ROUTES.get(route, GUNICORN_CONFIG.STATEMENT_TIMEOUT)
+    timeout = GUNICORN_CONFIG.STATEMENT_TIMEOUT_TABLES.get(f'{schema_name}.{table_name}', timeout)
+    statement_timeout.set(timeout)
+
+
+@event.listens_for(engine.sync_engine, "begin")
+def apply_statement_timeout(connection):
+    # the asyncpg adapter runs every statement inside its own transaction, so a plain SET would be rolled back
+    # with it; SET LOCAL is scoped to that transaction on purpose and nothing has to be remembered per connection.
+    # the raw cursor goes around Connection.execute, which would begin the transaction again from inside begin
+    timeout = int(statement_timeout.get())
+    if timeout == int(GUNICORN_CONFIG.STATEMENT_TIMEOUT):
+        return
+
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(f"SET LOCAL statement_timeout = {timeout}")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def start_statement_timer(connection, cursor, statement, parameters, context, executemany):
+    context.genapi_started_at = time.perf_counter()
+    context.genapi_span = start_leaf(KIND_SQL, ' '.join(statement.split()))
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def stop_statement_timer(connection, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, 'genapi_started_at', None)
+    if started_at is None:
+        return
+
+    elapsed = time.perf_counter() - started_at
+    add_db_time(elapsed)
+
+    span = getattr(context, 'genapi_span', None)
+    if span is not None:
+        span.finish()
+        span.detail = {'rows': cursor.rowcount}
+
+    stats = request_stats.get()
+    slow_query_log.record(statement, parameters, elapsed, cursor.rowcount, stats.route if stats else '', stats.shape if stats else '')
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def stop_failed_statement_timer(exception_context):
+    # statements killed by statement_timeout or cancelled never reach after_cursor_execute, and they are the slowest
+    context = exception_context.execution_context
+    started_at = getattr(context, 'genapi_started_at', None)
+    if started_at is None or exception_context.statement is None:
+        return
+
+    # the same execution context is not reported twice
+    context.genapi_started_at = None
+
+    elapsed = time.perf_counter() - started_at
+    add_db_time(elapsed)
+
+    span = getattr(context, 'genapi_span', None)
+    if span is not None:
+        span.finish()
+        span.detail = {'error': str(exception_context.original_exception)}
+
+    stats = request_stats.get()
+    slow_query_log.record(exception_context.statement, exception_context.parameters, elapsed, -1, stats.route if stats else '',
+                          stats.shape if stats else '', str(exception_context.original_exception))
+
+
+async def explain_statement(statement: str, parameters) -> dict:
+    # replayed on its own pooled connection straight through asyncpg, so the replay is neither timed nor logged,
+    # and rolled back so ANALYZE leaves nothing behind
+    async with engine.connect() as connection:
+        raw_connection = await connection.get_raw_connection()
+        driver_connection = raw_connection.driver_connection
+
+        transaction = driver_connection.transaction(readonly=True)
+        await transaction.start()
+        try:
+            plan = await driver_connection.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statement}", *(parameters or ()))
+        finally:
+            await transaction.rollback()
+
+    return orjson.loads(plan)[0] if isinstance(plan, str) else plan[0]
+
+
+slow_query_log.explain = explain_statement
 
-engine = create_engine(DATABASE_URL, echo=True)
 metadata = MetaData()
-database = Database(DATABASE_URL)
+notify_listener = NotifyListener(DATABASE_DSN)
+
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    # one session per request, the connection goes back to the pool when the request is done
+    async with async_session() as session:
+        yield session
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from typing import Callable, Dict
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+
+# keeps one dedicated asyncpg connection LISTENing on a set of channels, reconnecting when it drops
+class NotifyListener:
+    def __init__(self, dsn: str, reconnect_delay: float = 5.0) -> None:
+        super().__init__()
+
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.callbacks: Dict[str, Callable[[str], None]] = {}
+        self.on_reconnect: list[Callable[[], None]] = []
+        self.task: asyncio.Task = None
+
+    def add_channel(self, channel: str, callback: Callable[[str], None]) -> None:
+        self.callbacks[channel] = callback
+
+    def start(self) -> None:
+        if self.callbacks and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self) -> None:
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(self.dsn)
+                lost = asyncio.Event()
+                connection.add_termination_listener(lambda _: lost.set())
+
+                for channel, callback in self.callbacks.items():
+                    await connection.add_listener(channel, self.dispatcher(callback))
+
+                # anything may have changed while we were not listening
+                for callback in self.on_reconnect:
+                    callback()
+
+                await lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("notify listener error: %s", e)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+            await asyncio.sleep(self.reconnect_delay)
+
+    @staticmethod
+    def dispatcher(callback: Callable[[str], None]):
+        def _dispatch(connection, pid, channel, payload):
+            callback(payload)
+
+        return _dispatch
@@ -0,0 +1,74 @@
+import asyncio
+from collections import OrderedDict
+from typing import Tuple
+from config.config import GUNICORN_CONFIG
+
+GUARD_REJECT = 'reject'
+GUARD_QUEUE = 'queue'
+
+
+def plan_rows(plan: dict) -> float:
+    # rows the statement returns; the nodes below a LIMIT report what they would produce if run to the end,
+    # the work they actually do is in the total cost, which already accounts for the LIMIT stopping early
+    return plan.get('Plan Rows', 0)
+
+
+# admission control on the planner estimate of a statement, verdict inputs are cached per statement shape
+class QueryGuard:
+    def __init__(self, max_entries: int, concurrency: int) -> None:
+        super().__init__()
+
+        self.max_entries = max_entries
+        # (schema_name, table_name, statement) -> (total cost, rows), least recently used first
+        self.estimates: OrderedDict[Tuple[str, str, str], Tuple[float, float]] = OrderedDict()
+        # expensive statements that are queued instead of rejected run this many at a time
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def get(self, schema_name: str, table_name: str, statement: str):
+        estimate = self.estimates.get((schema_name, table_name, statement))
+        if estimate is not None:
+            self.estimates.move_to_end((schema_name, table_name, statement))
+
+        return estimate
+
+    def set(self, schema_name: str, table_name: str, statement: str, plan: dict) -> Tuple[float, float]:
+        estimate = (plan['Total Cost'], plan_rows(plan))
+        if self.max_entries > 0:
+            self.estimates[(schema_name, table_name, statement)] = estimate
+            while len(self.estimates) > self.max_entries:
+                self.estimates.popitem(last=False)
+
+        return estimate
+
+    def clear(self) -> None:
+        self.estimates.clear()
+
+    @staticmethod
+    def limits(schema_name: str, table_name: str) -> Tuple[float, float]:
+        # per table limits override the global ones, 0 means unlimited
+        table_limits = GUNICORN_CONFIG.QUERY_GUARD_TABLE_LIMITS.get(f'{schema_name}.{table_name}', {})
+
+        return (
+            table_limits.get('max_cost', GUNICORN_CONFIG.QUERY_GUARD_MAX_COST),
+            table_limits.get('max_rows', GUNICORN_CONFIG.QUERY_GUARD_MAX_ROWS),
+        )
+
+    @staticmethod
+    def combine(*estimates: Tuple[float, float]) -> Tuple[float, float]:
+        # statements of one request are admitted together, their costs add up; the rows are those of the first
+        return sum(cost for cost, _ in estimates), estimates[0][1]
+
+    def violation(self, schema_name: str, table_name: str, estimate: Tuple[float, float]):
+        max_cost, max_rows = self.limits(schema_name, table_name)
+        cost, rows = estimate
+
+        if max_cost and cost > max_cost:
+            return f'estimated cost {cost:.0f} exceeds the limit of {max_cost:.0f} for {schema_name}.{table_name}'
+
+        if max_rows and rows > max_rows:
+            return f'estimated {rows:.0f} rows exceed the limit of {max_rows:.0f} for {schema_name}.{table_name}'
+
+        return None
+
+
+query_guard = QueryGuard(GUNICORN_CONFIG.QUERY_GUARD_CACHE_SIZE, GUNICORN_CONFIG.QUERY_GUARD_QUEUE_CONCURRENCY)
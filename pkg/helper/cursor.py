@@ -0,0 +1,16 @@
+import base64
+import json
+
+
+# keyset cursors are opaque to the client: the ordering columns and the last seen values, base64 encoded
+def encode_cursor(key_columns: list[str], values: list) -> str:
+    payload = json.dumps({'k': key_columns, 'v': values}, default=str, separators=(',', ':'))
+
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[list[str], list]:
+    padded = cursor + '=' * (-len(cursor) % 4)
+    payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+
+    return payload['k'], payload['v']
@@ -0,0 +1,20 @@
+from datetime import timedelta
+from decimal import Decimal
+
+
+def json_default(value):
+    # orjson handles dicts, lists, datetimes and uuids natively, this covers the other column types
+    # the same way fastapi's jsonable_encoder does
+    if isinstance(value, Decimal) and value.is_finite():
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).decode(errors='replace')
+
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+
+    return str(value)
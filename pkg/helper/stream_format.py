@@ -0,0 +1,47 @@
+import csv
+import io
+import orjson
+
+
+def to_ndjson(records: list[dict]) -> bytes:
+    # Decimal and other non native types fall back to their string form
+    return b''.join(orjson.dumps(record, default=str) + b'\n' for record in records)
+
+
+class CsvWriter:
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.fieldnames = None
+
+    def format_value(self, value):
+        if isinstance(value, (dict, list)):
+            return orjson.dumps(value, default=str).decode()
+
+        return value
+
+    def write(self, records: list[dict]) -> bytes:
+        if not records:
+            return b''
+
+        buffer = io.StringIO()
+
+        # the header is taken from the first record of the first batch
+        if self.fieldnames is None:
+            self.fieldnames = list(records[0].keys())
+            writer = csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore')
+            writer.writeheader()
+        else:
+            writer = csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore')
+
+        for record in records:
+            writer.writerow({key: self.format_value(value) for key, value in record.items()})
+
+        return buffer.getvalue().encode()
+
+    def write_error(self, message: str) -> bytes:
+        # csv has no place for an error, a last row starting with #error tells the client the export is incomplete
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(['#error', message])
+
+        return buffer.getvalue().encode()
@@ -1,7 +1,9 @@
 from core.entity.catalog import SCHEMA_PUBLIC
 from typing import Tuple, Union
+from pkg.monitor.profiler import profiled, KIND_NORMALIZE
 
 
+@profiled(KIND_NORMALIZE)
 def normalize_schema_and_table_name(schema_name: Union[str, None], table_name: str) -> Tuple[str, str]:
     if '.' in table_name and schema_name is None:
         schema_name, table_name = table_name.split('.')
@@ -0,0 +1,93 @@
+import json
+import re
+from datetime import date, datetime, time
+from decimal import Decimal, InvalidOperation
+from uuid import UUID
+
+# asyncpg binds parameters with the column's binary codec, so values coming from JSON
+# (dates as strings, numbers as strings, ...) have to be turned into the matching python type first
+INTEGER_TYPES = {'smallint', 'integer', 'bigint'}
+FLOAT_TYPES = {'real', 'double precision'}
+TEXT_TYPES = {'text', 'character varying', 'character', 'name'}
+# data_type reports extension types such as citext as USER-DEFINED, the udt_name names them
+TEXT_UDT_NAMES = {'text', 'varchar', 'bpchar', 'citext', 'name'}
+JSON_TYPES = {'json', 'jsonb'}
+TIMESTAMP_TYPES = {'timestamp without time zone', 'timestamp with time zone'}
+TIME_TYPES = {'time without time zone', 'time with time zone'}
+TRUE_STRINGS = {'true', 't', '1', 'yes', 'y', 'on'}
+FALSE_STRINGS = {'false', 'f', '0', 'no', 'n', 'off'}
+INTEGER_PATTERN = re.compile(r'[+-]?\d+')
+
+
+def coerce_integer(value):
+    # only exact conversions, 1.5 must not silently become 1
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, Decimal) and value.is_finite() and value == value.to_integral_value():
+        return int(value)
+    if isinstance(value, str) and INTEGER_PATTERN.fullmatch(value.strip()):
+        return int(value)
+
+    return value
+
+
+def coerce_boolean(value):
+    if isinstance(value, str):
+        word = value.strip().lower()
+        if word in TRUE_STRINGS:
+            return True
+        if word in FALSE_STRINGS:
+            return False
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+
+    return value
+
+
+def coerce_value(data_type: str, value):
+    if value is None or data_type is None:
+        return value
+
+    try:
+        if data_type in INTEGER_TYPES:
+            return coerce_integer(value)
+        if data_type == 'numeric':
+            return Decimal(str(value))
+        if data_type in FLOAT_TYPES:
+            return float(value)
+        if data_type == 'boolean':
+            return coerce_boolean(value)
+        if data_type in TEXT_TYPES:
+            return value if isinstance(value, str) else str(value)
+        if data_type == 'uuid':
+            return value if isinstance(value, UUID) else UUID(str(value))
+        if data_type in JSON_TYPES:
+            return value if isinstance(value, str) else json.dumps(value, default=str)
+        if data_type == 'date' and isinstance(value, str):
+            return date.fromisoformat(value)
+        if data_type in TIMESTAMP_TYPES and isinstance(value, str):
+            return datetime.fromisoformat(value)
+        if data_type in TIME_TYPES and isinstance(value, str):
+            return time.fromisoformat(value)
+    except (ValueError, TypeError, InvalidOperation):
+        # leave it as is, postgres will answer with a proper error message
+        return value
+
+    return value
+
+
+def coerce_record(columns: list[dict], data: dict) -> dict:
+    column_types = {column['column_name']: column['data_type'] for column in columns}
+
+    return {key: coerce_value(column_types.get(key), value) for key, value in data.items()}
+
+
+def key_value(value):
+    # char(n) values come back padded while the request value is not, postgres itself ignores the padding
+    if isinstance(value, str):
+        return value.strip()
+
+    return value
@@ -0,0 +1,43 @@
+import time
+from typing import Dict, Tuple
+
+
+# in-process statistics of the filters clients actually send, per worker, reset on restart
+class FilterUsage:
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.started_at = time.time()
+        # (schema_name, table_name, column_name, operator) -> [calls, total seconds, max seconds]
+        self.entries: Dict[Tuple[str, str, str, str], list] = {}
+
+    def record(self, schema_name: str, table_name: str, conditions: list[Tuple[str, str]], elapsed: float) -> None:
+        # a column filtered twice in one request counts once
+        for column_name, operator in set(conditions):
+            entry = self.entries.setdefault((schema_name, table_name, column_name, operator), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+    def snapshot(self) -> list[dict]:
+        usage = []
+        for (schema_name, table_name, column_name, operator), (calls, total, maximum) in self.entries.items():
+            usage.append({
+                'schema_name': schema_name,
+                'table_name': table_name,
+                'column_name': column_name,
+                'operator': operator,
+                'calls': calls,
+                'total_ms': round(total * 1000, 3),
+                'mean_ms': round(total * 1000 / calls, 3),
+                'max_ms': round(maximum * 1000, 3),
+            })
+
+        return sorted(usage, key=lambda entry: entry['total_ms'], reverse=True)
+
+    def clear(self) -> None:
+        self.started_at = time.time()
+        self.entries.clear()
+
+
+filter_usage = FilterUsage()
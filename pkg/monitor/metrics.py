@@ -0,0 +1,220 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, Tuple
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def format_labels(label_names: Tuple[str, ...], labels: Tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the event loop is single threaded, so plain dicts and lists are enough, no locks anywhere
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        super().__init__()
+
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, labels: Tuple = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in self.values.items():
+            lines.append(f'{self.name}{format_labels(self.label_names, labels)} {value}')
+
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, labels: Tuple = ()) -> None:
+        self.values[labels] = value
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__()
+
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [count per bucket..., count above the last bucket, sum], cumulated only when rendered
+        self.series: Dict[Tuple, list] = {}
+
+    def observe(self, labels: Tuple, value: float) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, series in self.series.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names, labels, f'le="{bucket}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+
+            cumulative += series[-2]
+            bucket_labels = format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, labels)} {series[-1]}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, labels)} {cumulative}')
+
+        return lines
+
+
+# what one request spent, shared by reference with every task the request spawns
+class RequestStats:
+    __slots__ = ('started_at', 'route', 'requested_table', 'table', 'shape', 'db_seconds', 'statements', 'rows', 'bytes')
+
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.route = ''
+        # the table named by the client only becomes a label once the catalog knows it
+        self.requested_table = ''
+        self.table = ''
+        # the compiled filter of the request, placeholders only, for the slow query log
+        self.shape = ''
+        self.db_seconds = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+request_stats: ContextVar[RequestStats] = ContextVar('request_stats', default=None)
+
+# label of a table the catalog has not confirmed, client supplied names would grow the series without bound
+UNKNOWN_TABLE = 'unknown'
+
+REQUEST_LABELS = ('method', 'route', 'status', 'table')
+TABLE_LABELS = ('method', 'route', 'table')
+
+request_duration = Histogram('genapi_request_duration_seconds', 'Request latency.', REQUEST_LABELS)
+db_duration = Histogram('genapi_db_duration_seconds', 'Time a request spent in database statements.', TABLE_LABELS)
+python_duration = Histogram('genapi_python_duration_seconds', 'Time a request spent outside database statements.', TABLE_LABELS)
+db_statements = Counter('genapi_db_statements_total', 'Database statements executed.', TABLE_LABELS)
+rows_returned = Counter('genapi_rows_returned_total', 'Rows returned to clients.', TABLE_LABELS)
+response_bytes = Counter('genapi_response_bytes_total', 'Response body bytes serialized.', TABLE_LABELS)
+catalog_cache_requests = Counter('genapi_catalog_cache_requests_total', 'Catalog cache lookups.', ('kind', 'result'))
+response_cache_requests = Counter('genapi_response_cache_requests_total', 'Response cache lookups.', ('result',))
+pool_wait = Histogram('genapi_pool_wait_seconds', 'Time spent waiting for a pooled connection.')
+pool_connections = Gauge('genapi_pool_connections', 'Pooled connections by state.', ('state',))
+
+REGISTRY = [
+    request_duration, db_duration, python_duration, db_statements, rows_returned, response_bytes,
+    catalog_cache_requests, response_cache_requests, pool_wait, pool_connections,
+]
+
+
+def bind_table(schema_name: str, table_name: str) -> None:
+    stats = request_stats.get()
+    if stats is not None:
+        stats.requested_table = f'{schema_name}.{table_name}'
+        stats.table = UNKNOWN_TABLE
+
+
+def confirm_table(schema_name: str, table_name: str) -> None:
+    # called once the catalog returned the table, lookups of other (foreign) tables leave the label alone
+    stats = request_stats.get()
+    if stats is not None and stats.requested_table == f'{schema_name}.{table_name}':
+        stats.table = stats.requested_table
+
+
+def bind_route(route: str) -> None:
+    stats = request_stats.get()
+    if stats is not None:
+        stats.route = route
+
+
+def bind_shape(where_clauses: list[str]) -> None:
+    stats = request_stats.get()
+    if stats is not None:
+        stats.shape = ' AND '.join(where_clauses)
+
+
+def add_rows(rows: int) -> None:
+    stats = request_stats.get()
+    if stats is not None:
+        stats.rows += rows
+
+
+def add_db_time(elapsed: float) -> None:
+    stats = request_stats.get()
+    if stats is not None:
+        stats.db_seconds += elapsed
+        stats.statements += 1
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware, streaming responses pass through untouched and their bytes are still counted
+    def __init__(self, app) -> None:
+        super().__init__()
+
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                stats.bytes += len(message.get('body', b''))
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_stats.reset(token)
+
+            # the router stores the matched route in the scope, its path template keeps the label set small
+            route = scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            elapsed = time.perf_counter() - stats.started_at
+            labels = (scope['method'], route, stats.table)
+
+            request_duration.observe((scope['method'], route, status, stats.table), elapsed)
+            db_duration.observe(labels, stats.db_seconds)
+            python_duration.observe(labels, max(elapsed - stats.db_seconds, 0.0))
+            db_statements.inc(labels, stats.statements)
+            rows_returned.inc(labels, stats.rows)
+            response_bytes.inc(labels, stats.bytes)
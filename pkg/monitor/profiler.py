@@ -0,0 +1,284 @@
+import functools
+import inspect
+import logging
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from itertools import count
+from urllib.parse import parse_qs
+from fastapi.routing import APIRoute
+from config.config import GUNICORN_CONFIG
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = b'x-genapi-profile'
+PROFILE_QUERY = 'profile'
+# "cpu" additionally samples the stack of the event loop thread while the request runs
+PROFILE_CPU = 'cpu'
+
+KIND_REQUEST = 'request'
+KIND_VALIDATE = 'validate'
+KIND_NORMALIZE = 'normalize'
+KIND_CATALOG = 'catalog'
+KIND_PARSE = 'parse'
+KIND_SQL = 'sql'
+KIND_EXPAND = 'expand'
+KIND_SERIALIZE = 'serialize'
+
+
+class Span:
+    __slots__ = ('kind', 'name', 'started_at', 'elapsed', 'children', 'detail')
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.elapsed = None
+        self.children = []
+        self.detail = None
+
+    def child(self, kind: str, name: str) -> 'Span':
+        span = Span(kind, name)
+        self.children.append(span)
+
+        return span
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started_at
+
+    def to_dict(self, origin: float) -> dict:
+        node = {
+            'kind': self.kind,
+            'name': self.name,
+            'start_ms': round((self.started_at - origin) * 1000, 3),
+            # a span still running (a streamed body) reports None
+            'ms': round(self.elapsed * 1000, 3) if self.elapsed is not None else None,
+        }
+        if self.detail is not None:
+            node['detail'] = self.detail
+        if self.children:
+            node['children'] = [child.to_dict(origin) for child in self.children]
+
+        return node
+
+
+# the innermost open span of the request, None when the request is not profiled; tasks the request
+# spawns copy it, so spans opened by concurrent tasks land under the span that spawned them
+current_span: ContextVar[Span] = ContextVar('current_span', default=None)
+
+
+class span:
+    # `with span(kind, name):` is one contextvar read when the request is not profiled
+    __slots__ = ('kind', 'name', 'span', 'token')
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.span = None
+
+    def __enter__(self) -> 'span':
+        parent = current_span.get()
+        if parent is not None:
+            self.span = parent.child(self.kind, self.name)
+            self.token = current_span.set(self.span)
+
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.span is not None:
+            self.span.finish()
+            current_span.reset(self.token)
+
+
+def profiled(kind: str, name: str = None):
+    def decorator(function):
+        label = name or function.__qualname__
+
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                if current_span.get() is None:
+                    return await function(*args, **kwargs)
+
+                with span(kind, label):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if current_span.get() is None:
+                    return function(*args, **kwargs)
+
+                with span(kind, label):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def start_leaf(kind: str, name: str):
+    # for work that starts and ends in separate callbacks, e.g. the cursor execute events
+    parent = current_span.get()
+    if parent is None:
+        return None
+
+    return parent.child(kind, name)
+
+
+# the validation span of the request, still open until the endpoint starts
+validation_span: ContextVar[Span] = ContextVar('validation_span', default=None)
+
+
+def finish_validation() -> None:
+    span = validation_span.get()
+    if span is not None and span.elapsed is None:
+        span.finish()
+
+
+class ProfiledRoute(APIRoute):
+    # fastapi reads the body, validates it into the request model and solves the dependencies inside the route
+    # handler, right before it calls the endpoint; the span runs from the handler to the endpoint, so the models
+    # themselves stay free of instrumentation
+    def __init__(self, path: str, endpoint, **kwargs) -> None:
+        @functools.wraps(endpoint)
+        async def profiled_endpoint(*args, **kwargs):
+            finish_validation()
+            return await endpoint(*args, **kwargs)
+
+        super().__init__(path, profiled_endpoint if inspect.iscoroutinefunction(endpoint) else endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        name = f"{','.join(sorted(self.methods))} {self.path}"
+
+        async def profiled_handler(request):
+            if current_span.get() is None:
+                return await handler(request)
+
+            token = validation_span.set(start_leaf(KIND_VALIDATE, name))
+            try:
+                return await handler(request)
+            finally:
+                # a request that fails validation never reaches the endpoint
+                finish_validation()
+                validation_span.reset(token)
+
+        return profiled_handler
+
+
+class StackSampler(threading.Thread):
+    # samples one thread's stack from the side; the event loop thread serves other requests too, so the
+    # samples cover whatever the loop ran while this request was in flight
+    def __init__(self, thread_id: int, interval: float) -> None:
+        super().__init__(daemon=True)
+
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f'{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self) -> list[dict]:
+        self.stopped.set()
+        self.join()
+
+        # collapsed stacks, the format flame graph tools read
+        return [{'stack': stack, 'samples': samples} for stack, samples in self.stacks.most_common(GUNICORN_CONFIG.PROFILE_CPU_TOP_STACKS)]
+
+
+def server_timing(root: Span) -> str:
+    # time per kind, a span nested in a span of the same kind is already part of it
+    totals, counts = {}, {}
+
+    def walk(node: Span, open_kinds: frozenset) -> None:
+        for child in node.children:
+            if child.kind not in open_kinds and child.elapsed is not None:
+                totals[child.kind] = totals.get(child.kind, 0.0) + child.elapsed
+                counts[child.kind] = counts.get(child.kind, 0) + 1
+            walk(child, open_kinds | {child.kind})
+
+    walk(root, frozenset())
+
+    elapsed = time.perf_counter() - root.started_at
+    metrics = [f'{KIND_REQUEST};dur={elapsed * 1000:.3f}']
+    metrics.extend(f'{kind};dur={totals[kind] * 1000:.3f};desc="{counts[kind]}x"' for kind in totals)
+
+    return ', '.join(metrics)
+
+
+# the most recent profiles, newest last
+profiles = deque(maxlen=GUNICORN_CONFIG.PROFILE_BUFFER_SIZE)
+profile_ids = count(1)
+
+
+def requested_mode(scope) -> str:
+    for name, value in scope.get('headers', ()):
+        if name == PROFILE_HEADER:
+            return value.decode('latin-1').strip().lower()
+
+    values = parse_qs(scope.get('query_string', b'').decode('latin-1')).get(PROFILE_QUERY)
+    return values[-1].strip().lower() if values else ''
+
+
+class ProfileMiddleware:
+    # opt-in per request, the timing tree is logged and kept for /debug/profiles, the response carries
+    # Server-Timing and the id of the profile
+    def __init__(self, app) -> None:
+        super().__init__()
+
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not GUNICORN_CONFIG.PROFILE_ENABLED:
+            return await self.app(scope, receive, send)
+
+        mode = requested_mode(scope)
+        if mode in ('', '0', 'false'):
+            return await self.app(scope, receive, send)
+
+        profile_id = next(profile_ids)
+        root = Span(KIND_REQUEST, f"{scope['method']} {scope['path']}")
+        token = current_span.set(root)
+
+        sampler = None
+        if mode == PROFILE_CPU and GUNICORN_CONFIG.PROFILE_CPU_ENABLED:
+            sampler = StackSampler(threading.get_ident(), GUNICORN_CONFIG.PROFILE_CPU_INTERVAL)
+            sampler.start()
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', server_timing(root).encode('latin-1')))
+                headers.append((b'x-genapi-profile-id', str(profile_id).encode('latin-1')))
+                message = {**message, 'headers': headers}
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_span.reset(token)
+            root.finish()
+
+            profile = {'id': profile_id, 'at': time.time(), 'tree': root.to_dict(root.started_at)}
+            if sampler is not None:
+                profile['cpu'] = sampler.stop()
+
+            profiles.append(profile)
+            logger.info("profile %s %s: %.1f ms, %s", profile_id, root.name, root.elapsed * 1000, server_timing(root))
+
+
+def snapshot() -> list[dict]:
+    return list(reversed(profiles))
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from config.config import GUNICORN_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# only reads are replayed under EXPLAIN ANALYZE, and even those inside a transaction that is rolled back
+EXPLAINABLE_PREFIXES = ('SELECT', 'WITH')
+
+
+def redact(parameters) -> list[str]:
+    # values may be personal data, only their types are kept
+    if isinstance(parameters, dict):
+        parameters = list(parameters.values())
+
+    return [type(value).__name__ for value in (parameters or ())]
+
+
+# statements slower than the threshold, newest last, with a sampled EXPLAIN (ANALYZE, BUFFERS) plan
+class SlowQueryLog:
+    def __init__(self, threshold_ms: int, sample_rate: float, size: int) -> None:
+        super().__init__()
+
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.entries = deque(maxlen=size)
+        # async callable (statement, parameters) -> plan, set by the database module that owns the engine
+        self.explain = None
+        self.tasks = set()
+
+    def record(self, statement: str, parameters, elapsed: float, rows: int, route: str, shape: str, error: str = None) -> None:
+        if self.threshold <= 0 or elapsed < self.threshold:
+            return
+
+        entry = {
+            'at': time.time(),
+            'route': route,
+            'shape': shape,
+            'elapsed_ms': round(elapsed * 1000, 3),
+            'rows': rows,
+            'statement': statement,
+            'parameters': redact(parameters),
+            'error': error,
+            'plan': None,
+        }
+        self.entries.append(entry)
+        logger.warning("slow query %.1f ms, route %s, filter %s, %s rows%s: %s", elapsed * 1000, route or '-', shape or '-', rows,
+                       f', failed with {error}' if error else '', ' '.join(statement.split()))
+
+        # one replay at a time, the sample must not become a second source of load; a statement that was cancelled
+        # or hit statement_timeout would only be cancelled again
+        if (error is None and self.explain is not None and not self.tasks and random.random() < self.sample_rate
+                and statement.lstrip().upper().startswith(EXPLAINABLE_PREFIXES)):
+            task = asyncio.get_running_loop().create_task(self.capture_plan(entry, statement, parameters))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def capture_plan(self, entry: dict, statement: str, parameters) -> None:
+        try:
+            entry['plan'] = await self.explain(statement, parameters)
+        except Exception as e:
+            entry['plan'] = {'error': str(e)}
+
+    def snapshot(self) -> list[dict]:
+        return list(reversed(self.entries))
+
+
+slow_query_log = SlowQueryLog(GUNICORN_CONFIG.SLOW_QUERY_MS, GUNICORN_CONFIG.SLOW_QUERY_EXPLAIN_SAMPLE, GUNICORN_CONFIG.SLOW_QUERY_BUFFER_SIZE)
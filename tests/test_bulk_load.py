@@ -0,0 +1,74 @@
+import asyncio
+import asyncpg
+from core.repository.catalog_repository.implement import CatalogRepository
+
+
+class FakeTransaction:
+    def __init__(self, connection) -> None:
+        self.connection = connection
+
+    async def __aenter__(self):
+        self.connection.levels.append([])
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pending = self.connection.levels.pop()
+        if exc_type is None:
+            self.connection.target().extend(pending)
+
+
+class FakeDriverConnection:
+    # a COPY outside of a transaction commits at once, like asyncpg does
+    def __init__(self) -> None:
+        self.committed = []
+        self.levels = []
+
+    def target(self) -> list:
+        return self.levels[-1] if self.levels else self.committed
+
+    def transaction(self):
+        return FakeTransaction(self)
+
+    async def copy_records_to_table(self, table_name, schema_name, columns, records):
+        for record in records:
+            row = dict(zip(columns, record))
+            if row.get('name') == 'bad':
+                raise asyncpg.DataError('invalid input value')
+            self.target().append(row)
+
+
+class FakeSession:
+    def __init__(self, driver_connection) -> None:
+        self.driver_connection = driver_connection
+
+    async def connection(self):
+        return self
+
+    async def get_raw_connection(self):
+        return self
+
+    def begin_nested(self):
+        return FakeTransaction(self.driver_connection)
+
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+def test_copy_batch_with_mixed_key_sets_is_atomic():
+    driver_connection = FakeDriverConnection()
+    repository = CatalogRepository(FakeSession(driver_connection))
+
+    # two COPY groups, the second one fails
+    rows = [(0, {'name': 'a'}), (1, {'name': 'b', 'age': 2}), (2, {'name': 'bad', 'age': 3})]
+
+    async def load_batch(batch):
+        return await repository.copy_records('public', 'person', batch)
+
+    loaded, ids, failed = asyncio.run(repository.load_in_batches(rows, 3, load_batch))
+
+    assert loaded == 2
+    assert ids == []
+    assert [failure['index'] for failure in failed] == [2]
+    assert driver_connection.committed == [{'name': 'a'}, {'name': 'b', 'age': 2}]
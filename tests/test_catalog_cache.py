@@ -0,0 +1,55 @@
+import pytest
+from pkg.cache.catalog_cache import CatalogCache, CACHE_COLUMNS, CACHE_FOREIGN_KEYS, object_table
+
+
+def test_least_recently_used_table_is_evicted():
+    cache = CatalogCache(ttl=60, max_tables=2)
+    cache.set('public', 'a', CACHE_COLUMNS, ['a'])
+    cache.set('public', 'b', CACHE_COLUMNS, ['b'])
+
+    # reading a moves it to the end, b is now the oldest
+    assert cache.lookup('public', 'a', CACHE_COLUMNS) == ['a']
+    cache.set('public', 'c', CACHE_COLUMNS, ['c'])
+
+    assert list(cache.entries) == [('public', 'a'), ('public', 'c')]
+    assert cache.lookup('public', 'b', CACHE_COLUMNS) is None
+
+
+def test_expired_entries_drop_their_table():
+    cache = CatalogCache(ttl=60, max_tables=10)
+    cache.set('public', 'a', CACHE_FOREIGN_KEYS, [])
+    cache.entries[('public', 'a')][CACHE_FOREIGN_KEYS] = (0.0, [])
+
+    assert cache.lookup('public', 'a', CACHE_FOREIGN_KEYS) is None
+    assert not cache.has_table('public', 'a')
+
+
+def test_disabled_cache_stores_nothing():
+    cache = CatalogCache(ttl=0, max_tables=10)
+    cache.set('public', 'a', CACHE_COLUMNS, ['a'])
+
+    assert cache.entries == {}
+
+
+@pytest.mark.parametrize('object_identity, table', [
+    ('public.customer', ('public', 'customer')),
+    ('public.customer.name', ('public', 'customer')),
+    ('customer_pkey on public.customer', ('public', 'customer')),
+    ('"Sales"."Order"', ('Sales', 'Order')),
+    ('customer', None),
+    ('', None),
+])
+def test_object_table(object_identity, table):
+    assert object_table(object_identity) == table
+
+
+def test_unmapped_object_clears_the_cache():
+    cache = CatalogCache(ttl=60, max_tables=10)
+    cache.set('public', 'a', CACHE_COLUMNS, ['a'])
+    cache.set('public', 'b', CACHE_COLUMNS, ['b'])
+
+    cache.invalidate_object('public.a.name')
+    assert list(cache.entries) == [('public', 'b')]
+
+    cache.invalidate_object('some_function(integer)')
+    assert cache.entries == {}
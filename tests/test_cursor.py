@@ -0,0 +1,36 @@
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from uuid import UUID
+import pytest
+from pkg.helper.cursor import encode_cursor, decode_cursor
+from pkg.helper.type_coercion import coerce_value
+
+# last seen values of a page as asyncpg returns them, with the data_type of their column
+KEYSET_VALUES = [
+    ('integer', 42),
+    ('bigint', 9000000000),
+    ('numeric', Decimal('12.50')),
+    ('double precision', 0.25),
+    ('text', 'a,b "c"'),
+    ('boolean', False),
+    ('date', date(2024, 2, 29)),
+    ('timestamp with time zone', datetime(2024, 1, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)),
+    ('timestamp without time zone', datetime(2024, 1, 1, 12, 30)),
+    ('uuid', UUID('0b7e6a5c-3c48-4a43-9b2e-1f4d8a3f0e11')),
+]
+
+
+@pytest.mark.parametrize('data_type, value', KEYSET_VALUES)
+def test_keyset_values_survive_the_cursor(data_type, value):
+    key_columns, values = decode_cursor(encode_cursor(['created_at', 'id'], [value, 1]))
+
+    assert key_columns == ['created_at', 'id']
+    assert coerce_value(data_type, values[0]) == value
+    assert type(coerce_value(data_type, values[0])) is type(value)
+
+
+def test_cursor_is_url_safe_without_padding():
+    cursor = encode_cursor(['id'], ['??>>~~'])
+
+    assert '=' not in cursor and '+' not in cursor and '/' not in cursor
+    assert decode_cursor(cursor) == (['id'], ['??>>~~'])
@@ -0,0 +1,48 @@
+from unittest import mock
+import pytest
+from config.config import GUNICORN_CONFIG
+from pkg.guard.query_guard import QueryGuard, plan_rows
+
+
+@pytest.fixture
+def limits():
+    with mock.patch.object(GUNICORN_CONFIG, 'QUERY_GUARD_MAX_COST', 1000), \
+            mock.patch.object(GUNICORN_CONFIG, 'QUERY_GUARD_MAX_ROWS', 500), \
+            mock.patch.object(GUNICORN_CONFIG, 'QUERY_GUARD_TABLE_LIMITS', {'public.events': {'max_cost': 0, 'max_rows': 10}}):
+        yield
+
+
+def test_statement_within_the_limits_is_admitted(limits):
+    assert QueryGuard(16, 1).violation('public', 'orders', (1000, 500)) is None
+
+
+@pytest.mark.parametrize('estimate, violation', [
+    ((1001, 1), 'estimated cost 1001 exceeds the limit of 1000 for public.orders'),
+    ((10, 501), 'estimated 501 rows exceed the limit of 500 for public.orders'),
+])
+def test_statement_over_a_limit_is_reported(limits, estimate, violation):
+    assert QueryGuard(16, 1).violation('public', 'orders', estimate) == violation
+
+
+def test_table_limits_override_the_global_ones(limits):
+    guard = QueryGuard(16, 1)
+
+    # max_cost 0 lifts the cost limit for the table, its row limit is tighter
+    assert guard.violation('public', 'events', (10 ** 9, 10)) is None
+    assert guard.violation('public', 'events', (1, 11)) == 'estimated 11 rows exceed the limit of 10 for public.events'
+
+
+def test_combine_adds_the_costs_and_keeps_the_rows_of_the_first():
+    assert QueryGuard.combine((100, 20), (900, 10 ** 6)) == (1000, 20)
+
+
+def test_estimates_come_from_the_root_node_and_are_cached_per_statement():
+    guard = QueryGuard(1, 1)
+    plan = {'Total Cost': 42.5, 'Plan Rows': 20, 'Plans': [{'Total Cost': 40, 'Plan Rows': 10 ** 6}]}
+
+    assert plan_rows(plan) == 20
+    assert guard.set('public', 'orders', 'SELECT 1', plan) == (42.5, 20)
+    assert guard.get('public', 'orders', 'SELECT 1') == (42.5, 20)
+
+    guard.set('public', 'orders', 'SELECT 2', plan)
+    assert guard.get('public', 'orders', 'SELECT 1') is None
@@ -0,0 +1,90 @@
+import pytest
+from core.entity.catalog import Condition, Query, MAX_BIND_PARAMS
+from core.repository.catalog_repository.query_parser import QueryParser, compile_shape, arity_bucket, MAX_IN_LIST_PLACEHOLDERS
+
+COLUMNS = [
+    {'column_name': 'age', 'data_type': 'integer'},
+    {'column_name': 'name', 'data_type': 'text'},
+]
+
+
+@pytest.mark.parametrize('size, bucket', [(0, 1), (1, 1), (2, 2), (3, 4), (4, 4), (5, 8), (1000, 1024)])
+def test_arity_bucket(size, bucket):
+    assert arity_bucket(size) == bucket
+
+
+def test_values_are_bound_not_inlined():
+    where_clauses, params = QueryParser().audition_filter_columns(COLUMNS, [
+        Condition(column_name='name', operator='=', value="x'; DROP TABLE users; --"),
+        Condition(column_name='age', operator='>=', value='18'),
+    ])
+
+    assert where_clauses == ['(name = :p0 AND age >= :p1)']
+    assert params == {'p0': "x'; DROP TABLE users; --", 'p1': 18}
+
+
+def test_unknown_columns_and_operators_are_dropped():
+    conditions = [
+        Condition(column_name='missing', operator='=', value=1),
+        Condition(column_name='age', operator='; DELETE', value=1),
+    ]
+
+    assert QueryParser().audition_filter_columns(COLUMNS, conditions) == ([], {})
+    assert conditions[0].will_be_processed is False
+
+
+def test_nested_groups():
+    where_clauses, params = QueryParser().audition_filter_columns(COLUMNS, [
+        Condition(column_name='age', operator='<', value=65),
+        Query(or_=[
+            Condition(column_name='name', operator='ilike', value='a%'),
+            Query(and_=[Condition(column_name='age', operator='!=', value=30)]),
+        ]),
+    ])
+
+    assert where_clauses == ['(age < :p0 AND (name ILIKE :p1 OR (age != :p2)))']
+    assert params == {'p0': 65, 'p1': 'a%', 'p2': 30}
+
+
+def test_in_lists_are_padded_to_a_bucket():
+    where_clauses, params = QueryParser().audition_filter_columns(COLUMNS, [
+        Condition(column_name='age', operator='in', value=[1, 2, 3]),
+    ])
+
+    assert where_clauses == ['(age IN (:p0, :p1, :p2, :p3))']
+    assert params == {'p0': 1, 'p1': 2, 'p2': 3, 'p3': 3}
+
+
+@pytest.mark.parametrize('operator, clause', [('in', '(age = ANY(:p0))'), ('not in', '(age <> ALL(:p0))')])
+def test_long_in_lists_are_bound_as_one_array(operator, clause):
+    for size in (MAX_IN_LIST_PLACEHOLDERS + 1, MAX_BIND_PARAMS):
+        where_clauses, params = QueryParser().audition_filter_columns(COLUMNS, [
+            Condition(column_name='age', operator=operator, value=[str(item) for item in range(size)]),
+        ])
+
+        assert where_clauses == [clause]
+        assert params == {'p0': list(range(size))}
+
+
+def test_padded_in_lists_stay_under_the_bind_limit():
+    assert arity_bucket(MAX_IN_LIST_PLACEHOLDERS) <= MAX_IN_LIST_PLACEHOLDERS < MAX_BIND_PARAMS
+
+
+@pytest.mark.parametrize('operator, clause', [('in', '(FALSE)'), ('not in', '(TRUE)')])
+def test_empty_in_lists(operator, clause):
+    assert QueryParser().audition_filter_columns(COLUMNS, [Condition(column_name='age', operator=operator, value=[])]) == ([clause], {})
+
+
+def test_same_shape_same_statement():
+    query_parser = QueryParser()
+    first, first_params = query_parser.audition_filter_columns(COLUMNS, [Condition(column_name='age', operator='in', value=[1, 2, 3])])
+    second, second_params = query_parser.audition_filter_columns(COLUMNS, [Condition(column_name='age', operator='in', value=[7, 8, 9, 10])])
+
+    assert first == second
+    assert first_params != second_params
+
+
+def test_compile_shape_numbers_parameters_in_traversal_order():
+    shape = ('q', (('c', 'age', '=', None), ('q', (), (('c', 'name', 'LIKE', None), ('c', 'age', 'IN', 2)))), ())
+
+    assert compile_shape(shape) == '(age = :p0 AND (name LIKE :p1 OR age IN (:p2, :p3)))'
@@ -0,0 +1,84 @@
+import pytest
+from pkg.cache.response_cache import ResponseCache, etag_matches
+
+ORDERS = ('public', 'orders')
+CUSTOMERS = ('public', 'customers')
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2, max_bytes=1024, ttl=60)
+    cache.set('a', b'a', {ORDERS}, cache.version)
+    cache.set('b', b'b', {ORDERS}, cache.version)
+
+    assert cache.get('a') is not None
+    cache.set('c', b'c', {ORDERS}, cache.version)
+
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.tables[ORDERS] == {'a', 'c'}
+
+
+def test_byte_budget_evicts_until_it_fits():
+    cache = ResponseCache(max_entries=10, max_bytes=10, ttl=60)
+    cache.set('a', b'aaaa', {ORDERS}, cache.version)
+    cache.set('b', b'bbbb', {CUSTOMERS}, cache.version)
+    cache.set('c', b'cccc', {ORDERS}, cache.version)
+
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.size == 8
+
+    # a body larger than the whole budget is never stored
+    cache.set('d', b'd' * 11, {ORDERS}, cache.version)
+    assert 'd' not in cache.entries
+
+
+def test_expired_entry_is_a_miss():
+    cache = ResponseCache(max_entries=10, max_bytes=1024, ttl=60)
+    cache.set('a', b'a', {ORDERS}, cache.version)
+    etag, body, tables, _ = cache.entries['a']
+    cache.entries['a'] = (etag, body, tables, 0.0)
+
+    assert cache.get('a') is None
+    assert cache.entries == {} and cache.tables == {} and cache.size == 0
+
+
+def test_write_invalidates_only_the_responses_that_read_the_table():
+    cache = ResponseCache(max_entries=10, max_bytes=1024, ttl=60)
+    cache.set('orders', b'o', {ORDERS}, cache.version)
+    cache.set('join', b'j', {ORDERS, CUSTOMERS}, cache.version)
+    cache.set('customers', b'c', {CUSTOMERS}, cache.version)
+
+    cache.invalidate_object('public.orders')
+
+    assert list(cache.entries) == ['customers']
+    assert cache.tables == {CUSTOMERS: {'customers'}}
+
+
+def test_response_computed_across_a_write_is_not_stored():
+    cache = ResponseCache(max_entries=10, max_bytes=1024, ttl=60)
+    version = cache.version
+
+    cache.invalidate(*ORDERS)
+    etag = cache.set('a', b'a', {ORDERS}, version)
+
+    assert etag == ResponseCache.etag(b'a')
+    assert cache.get('a') is None
+
+
+def test_disabled_cache_still_returns_the_etag():
+    cache = ResponseCache(max_entries=0, max_bytes=1024, ttl=60)
+
+    assert cache.set('a', b'a', {ORDERS}, cache.version) == ResponseCache.etag(b'a')
+    assert cache.entries == {}
+
+
+@pytest.mark.parametrize('if_none_match, matches', [
+    ('"abc"', True),
+    ('W/"abc"', True),
+    ('"xyz", "abc"', True),
+    ('*', True),
+    ('"xyz"', False),
+    ('abc', False),
+    ('', False),
+])
+def test_etag_matches(if_none_match, matches):
+    assert etag_matches(if_none_match, '"abc"') is matches
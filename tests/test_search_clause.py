@@ -0,0 +1,27 @@
+import asyncio
+from core.entity.catalog import SEARCH_SEQUENTIAL
+from core.repository.catalog_repository.implement import CatalogRepository
+
+COLUMNS = [
+    {'column_name': 'id', 'data_type': 'integer', 'udt_name': 'int4'},
+    {'column_name': 'email', 'data_type': 'USER-DEFINED', 'udt_name': 'citext'},
+    {'column_name': 'code', 'data_type': 'character', 'udt_name': 'bpchar'},
+]
+
+
+def test_citext_columns_are_searched():
+    repository = CatalogRepository(None)
+
+    async def get_search_mode(schema_name, table_name):
+        return SEARCH_SEQUENTIAL
+
+    async def get_table_columns(req):
+        return COLUMNS
+
+    repository.get_search_mode = get_search_mode
+    repository.get_table_columns = get_table_columns
+
+    search_clause, params = asyncio.run(repository.get_search_clause('public', 'person', '50%'))
+
+    assert search_clause == '(email ILIKE :keyword OR code ILIKE :keyword)'
+    assert params == {'keyword': '%50\\%%'}
@@ -0,0 +1,24 @@
+import csv
+import io
+from pkg.helper.stream_format import CsvWriter
+
+
+def test_error_line_ends_the_csv_export():
+    writer = CsvWriter()
+    body = writer.write([{'id': 1, 'tags': ['a', 'b']}]) + writer.write([{'id': 2, 'tags': []}])
+    body += writer.write_error('canceling statement due to statement timeout, "orders"\nline 2')
+
+    rows = list(csv.reader(io.StringIO(body.decode())))
+
+    assert rows == [
+        ['id', 'tags'],
+        ['1', '["a","b"]'],
+        ['2', '[]'],
+        ['#error', 'canceling statement due to statement timeout, "orders"\nline 2'],
+    ]
+
+
+def test_error_before_any_record_is_the_only_line():
+    rows = list(csv.reader(io.StringIO(CsvWriter().write_error('permission denied').decode())))
+
+    assert rows == [['#error', 'permission denied']]
@@ -0,0 +1,34 @@
+from decimal import Decimal
+import pytest
+from core.entity.catalog import Condition
+from core.repository.catalog_repository.query_parser import QueryParser
+from pkg.helper.type_coercion import coerce_value
+
+
+@pytest.mark.parametrize('value, coerced', [(7, 7), ('42', 42), (' -3 ', -3), (2.0, 2), (Decimal('5.00'), 5)])
+def test_exact_integers_are_converted(value, coerced):
+    assert coerce_value('integer', value) == coerced
+    assert type(coerce_value('integer', value)) is int
+
+
+@pytest.mark.parametrize('value', [1.5, '1.5', Decimal('2.5'), 'ten', float('inf'), Decimal('NaN')])
+def test_inexact_integers_are_left_for_postgres(value):
+    assert coerce_value('integer', value) is value
+
+
+def test_fractional_filter_value_is_not_truncated():
+    _, params = QueryParser().audition_filter_columns([{'column_name': 'age', 'data_type': 'integer'}], [
+        Condition(column_name='age', operator='<', value=1.5),
+    ])
+
+    assert params == {'p0': 1.5}
+
+
+@pytest.mark.parametrize('value, coerced', [('true', True), (' Yes ', True), ('f', False), ('OFF', False), (1, True), (0, False), (True, True)])
+def test_known_boolean_words_are_converted(value, coerced):
+    assert coerce_value('boolean', value) is coerced
+
+
+@pytest.mark.parametrize('value', ['nope', '', 2, 0.5])
+def test_unknown_boolean_values_are_left_for_postgres(value):
+    assert coerce_value('boolean', value) is value